@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import config
+import database
+
+# Сравнение пропускной способности SQLite с настройками по умолчанию и с
+# профилем из config.SQLITE_PRAGMAS. Каждый симулируемый пользователь
+# повторяет типичный цикл бота: читает меню и корзину, сохраняет состояние.
+#
+#   python bench_sqlite.py --users 200 --iterations 50
+
+
+async def simulate_user(repository, user_id, iterations, stats):
+    for i in range(iterations):
+        async with repository.reader() as db:
+            async with db.execute('SELECT * FROM burgers ORDER BY id') as cursor:
+                await cursor.fetchall()
+            async with db.execute('SELECT burger_id, quantity FROM cart WHERE user_id = ?', (user_id,)) as cursor:
+                await cursor.fetchall()
+        async with repository.writer() as db:
+            await db.execute('REPLACE INTO user_states (user_id, state, data) VALUES (?, ?, ?)',
+                             (user_id, f'step_{i}', '{}'))
+        stats['commits'] += 1
+        if random.random() < 0.2:
+            async with repository.writer() as db:
+                await db.execute(database.ADD_TO_CART_SQL, (user_id, random.randint(1, 20), 1, int(time.time())))
+            stats['commits'] += 1
+
+
+async def run_profile(name, pragmas, users, iterations, readers):
+    with tempfile.TemporaryDirectory() as tmp:
+        repository = database.Repository(os.path.join(tmp, 'bench.db'), readers, pragmas)
+        await repository.init_db()
+        async with repository.writer() as db:
+            await db.executemany('INSERT INTO burgers (name, description, price) VALUES (?, ?, ?)',
+                                 [(f'Бургер {i}', 'Описание', 100 + i) for i in range(20)])
+
+        stats = {'commits': 0}
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate_user(repository, user_id, iterations, stats) for user_id in range(users)))
+        elapsed = time.perf_counter() - started
+        await repository.close()
+
+    print(f'{name:>8}: {stats["commits"]} commits in {elapsed:.2f}s -> {stats["commits"] / elapsed:,.0f} commits/s')
+    return stats['commits'] / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='SQLite commits/sec with default and tuned pragmas')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--readers', type=int, default=config.DB_POOL_READERS)
+    args = parser.parse_args()
+
+    default = await run_profile('default', {}, args.users, args.iterations, args.readers)
+    tuned = await run_profile('tuned', config.SQLITE_PRAGMAS, args.users, args.iterations, args.readers)
+    print(f'speedup: x{tuned / default:.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,20 +1,74 @@
 import asyncio
-import atexit
+import hmac
+import multiprocessing
+import signal
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
-from aiogram.filters import Command
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, ShippingOption
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import config
-import database
 import logging
+import metrics
+from broadcast import Broadcaster
+from callbacks import (AddToCartCallback, BurgerCallback, BuyCallback, CallbackRouter, DecreaseCallback,
+                       DeleteCallback, IncreaseCallback, InvoicePayload, MenuPageCallback, QuantityCallback,
+                       RemoveCallback)
+from catalog import catalog
+from compaction import Compactor
+from debounce import QuantityEditDebouncer
+from idempotency import IdempotencyMiddleware
+from database import cart_digest, current_hour, repository
+from keyboards import menu_keyboard, quantity_keyboard
+from outbox import Outbox
+from storage import WriteBehindStorage, make_storage
+from user_queue import UserSerialMiddleware
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 TOKEN = config.TOKEN
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
-dp.setup_bot(bot)
+bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(config.TELEGRAM_API_URL)))
+storage = make_storage()
+dp = Dispatcher(storage=storage)
+outbox = Outbox(bot)
+quantity_edits = QuantityEditDebouncer(bot)
+broadcaster = Broadcaster(outbox)
+compactor = Compactor()
+# Номер процесса при запуске нескольких работников (см. configure_worker).
+worker_index = 0
+idempotency = IdempotencyMiddleware()
+user_queue = UserSerialMiddleware()
+# Дубли отсекаются раньше, чем состояние FSM читается из хранилища и
+# обновление попадает в очередь пользователя.
+idempotency.setup(dp)
+dp.update.outer_middleware(user_queue)
+callbacks = CallbackRouter()
+
+if config.METRICS_ENABLED:
+    metrics.instrument(repository)
+    dp.message.middleware(metrics.HandlerMetricsMiddleware())
+    dp.callback_query.middleware(metrics.HandlerMetricsMiddleware())
+    dp.inline_query.middleware(metrics.HandlerMetricsMiddleware())
+    dp.shipping_query.middleware(metrics.HandlerMetricsMiddleware())
+    dp.pre_checkout_query.middleware(metrics.HandlerMetricsMiddleware())
+    bot.session.middleware(metrics.ApiMetricsMiddleware())
+    metrics.watch_outbox(outbox)
+    metrics.watch_user_queue(user_queue)
+    metrics.watch_quantity_edits(quantity_edits)
+    metrics.watch_idempotency(idempotency)
+
+# Варианты доставки не зависят от корзины, поэтому собираются один раз.
+SHIPPING_OPTIONS = [
+    ShippingOption(id=option_id, title=title, prices=[LabeledPrice(label=title, amount=price)])
+    for option_id, title, price in config.SHIPPING_RATES
+]
+SHIPPING_PRICES = {option_id: price for option_id, _, price in config.SHIPPING_RATES}
 
 commands = [
     '/start - Приветственное сообщение',
@@ -25,182 +79,204 @@ commands = [
 
 
 @dp.message(Command("start"))
-async def start(message: types.Message):
-    user_id = message.from_user.id
-    state = await database.async_get_user_state(user_id)
-    if state:
-        await message.reply(f'Добро пожаловать обратно! Последний раз вы были: {state}')
+async def start(message: types.Message, state: FSMContext):
+    last_state = await state.get_state()
+    if last_state:
+        await message.reply(f'Добро пожаловать обратно! Последний раз вы были: {last_state}')
     else:
         await message.reply('Добро пожаловать в наш магазин бургеров!')
-    await database.async_save_user_state(user_id, 'start')
+    await state.set_state('start')
     await message.reply('Доступные команды:\n' + '\n'.join(commands))
 
 
 @dp.message(Command("help"))
-async def help_command(message: types.Message):
-    user_id = message.from_user.id
-    await database.async_save_user_state(user_id, 'help')
+async def help_command(message: types.Message, state: FSMContext):
+    await state.set_state('help')
     await message.reply('Доступные команды:\n' + '\n'.join(commands))
 
 
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, command: CommandObject):
+    if message.from_user.id != config.ADMIN_USER_ID:
+        await message.reply('Команда доступна только администратору.')
+        return
+    if not command.args:
+        await message.reply('Использование: /broadcast <текст сообщения>')
+        return
+
+    broadcast_id = await broadcaster.start(command.args, on_finish=report_broadcast)
+    await message.reply(f'Рассылка #{broadcast_id} запущена.')
+
+
+@dp.message(Command("stats"))
+async def stats_command(message: types.Message, command: CommandObject):
+    if message.from_user.id != config.ADMIN_USER_ID:
+        await message.reply('Команда доступна только администратору.')
+        return
+    hours = int(command.args) if command.args and command.args.strip().isdigit() else 24
+    hours = min(max(hours, 1), config.STATS_MAX_HOURS)
+
+    orders, revenue, rows = await repository.get_sales_stats(current_hour() - hours + 1)
+    text = f'Статистика за {hours} ч.\nЗаказов: {orders}, выручка с доставкой: {revenue / 100} руб.'
+    if rows:
+        text += '\n\nЗаказано / добавлено / удалено, сумма без доставки:'
+        for burger_id, added, removed, ordered, burger_revenue in rows[:config.STATS_TOP_BURGERS]:
+            burger = await catalog.get(burger_id)
+            name = burger[1] if burger else f'#{burger_id}'
+            text += f'\n{name}: {ordered} / {added} / {removed}, {burger_revenue / 100} руб.'
+    await message.reply(text)
+
+
+def report_broadcast(broadcast_id, sent, failed, rate):
+    outbox.send(config.ADMIN_USER_ID, f'Рассылка #{broadcast_id} завершена: доставлено {sent}, '
+                                      f'не доставлено {failed}, {rate:.0f} сообщений/с.')
+
+
 @dp.message(Command("burgers"))
-async def list_burgers(message: types.Message):
-    user_id = message.from_user.id
-    await database.async_save_user_state(user_id, 'burgers')
-    burgers = await database.async_get_burgers()
+async def list_burgers(message: types.Message, state: FSMContext):
+    await state.set_state('burgers')
+    burgers, has_prev, has_next = await catalog.page()
     if not burgers:
         await message.reply('Бургеров пока нет.')
         return
 
-    keyboard = []
-    for burger in burgers:
-        keyboard.append([InlineKeyboardButton(text=burger[1], callback_data=f'burger_{burger[0]}')])
+    await message.reply('Выберите бургер:', reply_markup=menu_keyboard(burgers, catalog.version, has_prev, has_next))
 
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-    await message.reply('Выберите бургер:', reply_markup=reply_markup)
 
+@dp.inline_query()
+async def search_burgers(inline_query: types.InlineQuery):
+    query = inline_query.query.strip()
+    if query:
+        burgers = await repository.search_burgers(query, config.SEARCH_RESULTS_LIMIT)
+    else:
+        burgers, _, _ = await catalog.page(size=config.SEARCH_RESULTS_LIMIT)
+
+    results = [
+        types.InlineQueryResultArticle(
+            id=str(burger[0]),
+            title=burger[1],
+            description=f'{burger[3]} руб. {burger[2] or ""}'.strip(),
+            input_message_content=types.InputTextMessageContent(
+                message_text=f'{burger[1]}\n\n{burger[2] or ""}\n\nЦена: {burger[3]}'
+            )
+        )
+        for burger in burgers
+    ]
+    await bot.answer_inline_query(inline_query.id, results, cache_time=config.CATALOG_TTL)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('burger_'))
-async def burger_details(callback_query: types.CallbackQuery):
-    await bot.answer_callback_query(callback_query.id)
 
-    burger_id = int(callback_query.data.split('_')[1])
-    burgers = await database.async_get_burgers()
-    burger = next((b for b in burgers if b[0] == burger_id), None)
+@dp.callback_query(callbacks)
+async def route_callback(callback_query: types.CallbackQuery, route, **kwargs):
+    return await route.call(callback_query, **kwargs)
 
-    if burger:
-        text = f'{burger[1]}\n\n{burger[2]}\n\nЦена: {burger[3]}'
-        user_id = callback_query.from_user.id
-        await database.async_save_user_state(user_id, f'awaiting_quantity_{burger_id}_1')
 
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text='-', callback_data=f'decrease_{burger_id}'),
-            InlineKeyboardButton(text='1', callback_data=f'quantity_{burger_id}_1'),
-            InlineKeyboardButton(text='+', callback_data=f'increase_{burger_id}')
-        )
-        builder.row(
-            InlineKeyboardButton(text='Добавить в корзину', callback_data=f'add_to_cart_{burger_id}')
-        )
-
-        await bot.send_message(callback_query.message.chat.id, f'{text}\n\nВыберите количество бургеров:',
-                               reply_markup=builder.as_markup())
-    else:
-        await bot.send_message(callback_query.message.chat.id, 'Бургер не найден.')
+@dp.callback_query()
+async def outdated_callback(callback_query: types.CallbackQuery):
+    # Кнопки старых сообщений (до смены формата callback_data) и неизвестные данные.
+    await bot.answer_callback_query(callback_query.id, 'Кнопка устарела, откройте меню заново.')
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('increase_'))
-async def increase_quantity(callback_query: types.CallbackQuery):
+@callbacks.route(MenuPageCallback)
+async def menu_page(callback_query: types.CallbackQuery, callback_data: MenuPageCallback):
     await bot.answer_callback_query(callback_query.id)
 
-    burger_id = int(callback_query.data.split('_')[1])
-    user_id = callback_query.from_user.id
-    state = await database.async_get_user_state(user_id)
+    if callback_data.direction == 'prev':
+        burgers, has_prev, has_next = await catalog.page(before=callback_data.burger_id)
+    else:
+        burgers, has_prev, has_next = await catalog.page(after=callback_data.burger_id)
+    if not burgers:
+        # Меню успело измениться, начинаем сначала.
+        burgers, has_prev, has_next = await catalog.page()
+    if not burgers:
+        return
 
-    if state and state.startswith('awaiting_quantity_'):
-        current_quantity = int(state.split('_')[3])
-        new_quantity = current_quantity + 1
-        await database.async_save_user_state(user_id, f'awaiting_quantity_{burger_id}_{new_quantity}')
+    await bot.edit_message_reply_markup(
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        reply_markup=menu_keyboard(burgers, catalog.version, has_prev, has_next)
+    )
 
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text='-', callback_data=f'decrease_{burger_id}'),
-            InlineKeyboardButton(text=str(new_quantity), callback_data=f'quantity_{burger_id}_{new_quantity}'),
-            InlineKeyboardButton(text='+', callback_data=f'increase_{burger_id}')
-        )
-        builder.row(
-            InlineKeyboardButton(text='Добавить в корзину', callback_data=f'add_to_cart_{burger_id}')
-        )
 
-        await bot.edit_message_reply_markup(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-            reply_markup=builder.as_markup()
-        )
+@callbacks.route(BurgerCallback)
+async def burger_details(callback_query: types.CallbackQuery, callback_data: BurgerCallback, state: FSMContext):
+    await bot.answer_callback_query(callback_query.id)
 
+    burger_id = callback_data.burger_id
+    burger = await catalog.get(burger_id)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('decrease_'))
-async def decrease_quantity(callback_query: types.CallbackQuery):
-    await bot.answer_callback_query(callback_query.id)
+    if burger:
+        text = f'{burger[1]}\n\n{burger[2]}\n\nЦена: {burger[3]}'
+        # Количество живёт в кнопках, в состоянии только бургер для ввода числом.
+        await state.set_state('awaiting_quantity')
+        await state.set_data({'burger_id': burger_id})
 
-    burger_id = int(callback_query.data.split('_')[1])
-    user_id = callback_query.from_user.id
-    state = await database.async_get_user_state(user_id)
+        outbox.send(callback_query.message.chat.id, f'{text}\n\nВыберите количество бургеров:',
+                    reply_markup=quantity_keyboard(burger_id, 1))
+    else:
+        outbox.send(callback_query.message.chat.id, 'Бургер не найден.')
 
-    if state and state.startswith('awaiting_quantity_'):
-        current_quantity = int(state.split('_')[3])
-        new_quantity = max(current_quantity - 1, 1)
-        await database.async_save_user_state(user_id, f'awaiting_quantity_{burger_id}_{new_quantity}')
 
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text='-', callback_data=f'decrease_{burger_id}'),
-            InlineKeyboardButton(text=str(new_quantity), callback_data=f'quantity_{burger_id}_{new_quantity}'),
-            InlineKeyboardButton(text='+', callback_data=f'increase_{burger_id}')
-        )
-        builder.row(
-            InlineKeyboardButton(text='Добавить в корзину', callback_data=f'add_to_cart_{burger_id}')
-        )
+def picker_quantity(callback_query: types.CallbackQuery, callback_data):
+    # Пока правка клавиатуры отложена или в пути, на кнопках ещё старое количество.
+    quantity = quantity_edits.current_quantity(callback_query.message.chat.id, callback_query.message.message_id)
+    return callback_data.quantity if quantity is None else quantity
 
-        await bot.edit_message_reply_markup(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-            reply_markup=builder.as_markup()
-        )
+
+@callbacks.route(IncreaseCallback)
+async def increase_quantity(callback_query: types.CallbackQuery, callback_data: IncreaseCallback, repeat: int = 1):
+    await bot.answer_callback_query(callback_query.id)
+
+    current_quantity = picker_quantity(callback_query, callback_data)
+    quantity_edits.schedule(callback_query.message.chat.id, callback_query.message.message_id,
+                            callback_data.burger_id, current_quantity, current_quantity + repeat)
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('add_to_cart_'))
-async def add_to_cart(callback_query: types.CallbackQuery):
+@callbacks.route(DecreaseCallback)
+async def decrease_quantity(callback_query: types.CallbackQuery, callback_data: DecreaseCallback, repeat: int = 1):
     await bot.answer_callback_query(callback_query.id)
 
-    data_parts = callback_query.data.split('_')
-    print(f"Callback data: {callback_query.data}")  # Добавлено для отладки
+    current_quantity = picker_quantity(callback_query, callback_data)
+    quantity_edits.schedule(callback_query.message.chat.id, callback_query.message.message_id,
+                            callback_data.burger_id, current_quantity, max(current_quantity - repeat, 1))
 
-    if len(data_parts) < 4:
-        await bot.send_message(callback_query.message.chat.id, 'Ошибка: некорректные данные.')
-        return
 
-    try:
-        burger_id = int(data_parts[3])
-    except ValueError:
-        await bot.send_message(callback_query.message.chat.id, 'Ошибка: некорректный идентификатор бургера.')
-        return
+@callbacks.route(QuantityCallback)
+async def show_quantity(callback_query: types.CallbackQuery, callback_data: QuantityCallback):
+    await bot.answer_callback_query(callback_query.id, f'Выбрано: {picker_quantity(callback_query, callback_data)}')
 
-    user_id = callback_query.from_user.id
-    state = await database.async_get_user_state(user_id)
 
-    if state and state.startswith('awaiting_quantity_'):
-        try:
-            quantity = int(state.split('_')[3])
-        except ValueError:
-            await bot.send_message(callback_query.message.chat.id, 'Ошибка: некорректное количество бургеров.')
-            return
+@callbacks.route(AddToCartCallback)
+async def add_to_cart(callback_query: types.CallbackQuery, callback_data: AddToCartCallback, state: FSMContext):
+    await bot.answer_callback_query(callback_query.id)
+
+    chat_id = callback_query.message.chat.id
+    quantity = picker_quantity(callback_query, callback_data)
+    await quantity_edits.flush(chat_id, callback_query.message.message_id)
 
-        await database.async_add_to_cart(user_id, burger_id, quantity)
-        await bot.send_message(callback_query.message.chat.id, f'Добавлено {quantity} бургеров в корзину!')
-        await database.async_save_user_state(user_id, 'start')
-        await bot.send_message(callback_query.message.chat.id, 'Доступные команды:\n' + '\n'.join(commands))
+    await repository.add_to_cart(callback_query.from_user.id, callback_data.burger_id, quantity)
+    outbox.send(chat_id, f'Добавлено {quantity} бургеров в корзину!')
+    await state.set_state('start')
+    outbox.send(chat_id, 'Доступные команды:\n' + '\n'.join(commands))
 
 
-@dp.message(lambda message: message.text.isdigit())
-async def handle_quantity_input(message: types.Message):
+@dp.message(lambda message: message.text and message.text.isdigit())
+async def handle_quantity_input(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_state = await database.async_get_user_state(user_id)
 
-    if user_state and user_state.startswith('awaiting_quantity_'):
-        burger_id = int(user_state.split('_')[2])
+    if await state.get_state() == 'awaiting_quantity':
+        burger_id = (await state.get_data())['burger_id']
         quantity = int(message.text)
 
         if quantity > 0:
             try:
-                await database.async_add_to_cart(user_id, burger_id, quantity)
-                await message.reply(f'Добавлено {quantity} бургеров в корзину!')
-                await message.reply('Доступные команды:\n' + '\n'.join(commands))
-            except Exception as e:
-                print(f"Error adding to cart: {e}")
+                await repository.add_to_cart(user_id, burger_id, quantity)
+                outbox.send(message.chat.id, f'Добавлено {quantity} бургеров в корзину!')
+                outbox.send(message.chat.id, 'Доступные команды:\n' + '\n'.join(commands))
+            except Exception:
+                logger.exception('Error adding to cart')
                 await message.reply('Произошла ошибка при добавлении бургеров в корзину.')
 
-            await database.async_save_user_state(user_id, 'start')
+            await state.set_state('start')
         else:
             await message.reply('Количество должно быть больше нуля.')
     else:
@@ -208,66 +284,43 @@ async def handle_quantity_input(message: types.Message):
 
 
 @dp.message(Command("cart"))
-async def view_cart(message: types.Message):
+async def view_cart(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    await database.async_save_user_state(user_id, 'cart')
-    cart_items = await database.async_get_cart(user_id)
-    if not cart_items:
+    await state.set_state('cart')
+    lines, total = await repository.get_cart_summary(user_id)
+    if not lines:
         await message.reply('Ваша корзина пуста.')
         return
 
     cart_text = 'Ваша корзина:\n'
-    total_price = 0
-    burger_counts = {}
-    for item in cart_items:
-        burger_name = item[1]
-        burger_price = item[3]
-        quantity = item[4]
-        if burger_name in burger_counts:
-            burger_counts[burger_name]['quantity'] += quantity
-        else:
-            burger_counts[burger_name] = {'price': burger_price, 'quantity': quantity, 'id': item[0]}
-
     keyboard = []
-    for burger_name, data in burger_counts.items():
-        cart_text += f'{burger_name} - {data["price"]} руб. (Количество: {data["quantity"]})\n'
-        total_price += data["price"] * data["quantity"]
-        keyboard.append([InlineKeyboardButton(text=f'Удалить {burger_name}', callback_data=f'delete_{data["id"]}')])
+    for burger_id, burger_name, price, quantity in lines:
+        cart_text += f'{burger_name} - {price} руб. (Количество: {quantity})\n'
+        keyboard.append([InlineKeyboardButton(text=f'Удалить {burger_name}', callback_data=DeleteCallback(burger_id=burger_id).pack())])
 
-    cart_text += f'\nИтого: {total_price} руб.'
-
-   
-    keyboard.append([InlineKeyboardButton(text='Купить', callback_data='buy')])
+    cart_text += f'\nИтого: {total / 100} руб.'
+    keyboard.append([InlineKeyboardButton(text='Купить', callback_data=BuyCallback().pack())])
 
     reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
     await message.reply(cart_text, reply_markup=reply_markup)
 
 
-@dp.callback_query(lambda c: c.data and c.data == 'buy')
+@callbacks.route(BuyCallback)
 async def buy(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
 
     user_id = callback_query.from_user.id
-    cart_items = await database.async_get_cart(user_id)
-    if not cart_items:
+    lines, total_price = await repository.get_cart_summary(user_id)
+    if not lines:
         await bot.edit_message_text('Ваша корзина пуста.', chat_id=callback_query.message.chat.id,
                                     message_id=callback_query.message.message_id)
         return
 
-    await send_invoice(callback_query)
-
+    await send_invoice(callback_query, lines, total_price)
 
-async def send_invoice(callback_query: types.CallbackQuery):
-    await bot.answer_callback_query(callback_query.id)
 
-    user_id = callback_query.from_user.id
-    cart_items = await database.async_get_cart(user_id)
-    if not cart_items:
-        await bot.edit_message_text('Ваша корзина пуста.', chat_id=callback_query.message.chat.id,
-                                    message_id=callback_query.message.message_id)
-        return
-
-    total_price = await calculate_total_price(cart_items)
+async def send_invoice(callback_query: types.CallbackQuery, lines, total_price):
+    payload = InvoicePayload(user_id=callback_query.from_user.id, total=total_price, cart=cart_digest(lines)).pack()
     logging.info("Sending invoice to user")
     await bot.send_invoice(
         chat_id=callback_query.message.chat.id,
@@ -282,106 +335,391 @@ async def send_invoice(callback_query: types.CallbackQuery):
         need_shipping_address=True,
         is_flexible=True,
         start_parameter='example',
-        payload='some-invoice-payload'
+        payload=payload
     )
     logging.info("Invoice sent successfully")
 
 
-async def calculate_total_price(cart_items):
-    total_price = 0
-    for item in cart_items:
-        total_price += item[3] * item[4] * 100  # item[3] - цена в рублях, item[4] - количество
-    return int(total_price)
+@dp.shipping_query()
+async def shipping_query(shipping_query: types.ShippingQuery):
+    if shipping_query.shipping_address.country_code not in config.SHIPPING_COUNTRIES:
+        await bot.answer_shipping_query(shipping_query.id, ok=False,
+                                        error_message='К сожалению, в эту страну мы не доставляем.')
+        return
+    await bot.answer_shipping_query(shipping_query.id, ok=True, shipping_options=SHIPPING_OPTIONS)
+
+
+async def check_pre_checkout(pre_checkout_query: types.PreCheckoutQuery):
+    # Возвращает текст ошибки для покупателя или None, если заказ можно оплатить.
+    try:
+        payload = InvoicePayload.unpack(pre_checkout_query.invoice_payload)
+    except (TypeError, ValueError):
+        return 'Счёт устарел. Оформите заказ заново.'
+    if payload.user_id != pre_checkout_query.from_user.id:
+        return 'Этот счёт выставлен другому пользователю.'
+
+    shipping_price = SHIPPING_PRICES.get(pre_checkout_query.shipping_option_id)
+    if shipping_price is None:
+        return 'Выберите способ доставки.'
+    if pre_checkout_query.total_amount != payload.total + shipping_price:
+        return 'Сумма счёта не совпадает с заказом. Оформите заказ заново.'
+
+    # Из базы, а не из кэша: перед списанием денег корзина должна быть настоящей.
+    lines, cart_total = await repository.get_cart_summary(payload.user_id, cached=False)
+    if cart_total != payload.total or cart_digest(lines) != payload.cart:
+        return 'Корзина изменилась после выставления счёта. Оформите заказ заново.'
+    return None
+
+
+@dp.pre_checkout_query()
+async def pre_checkout(pre_checkout_query: types.PreCheckoutQuery):
+    error = await check_pre_checkout(pre_checkout_query)
+    if error:
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message=error)
+    else:
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+
+
+@dp.message(lambda message: message.successful_payment is not None)
+async def successful_payment(message: types.Message, state: FSMContext):
+    payment = message.successful_payment
+    order_info = payment.order_info
+    address = order_info.shipping_address if order_info else None
+    # Заказ собирается из корзины, только если она та же, что в счёте.
+    payload = InvoicePayload.unpack(payment.invoice_payload)
+
+    items = await repository.create_order(
+        message.from_user.id,
+        ', '.join(filter(None, (address.street_line1, address.street_line2))) if address else '',
+        address.city if address else '',
+        address.post_code if address else '',
+        (order_info and order_info.email) or '',
+        (order_info and order_info.phone_number) or '',
+        cart=payload.cart,
+        paid=payment.total_amount
+    )
+    await state.set_state('start')
+    if items is None:
+        await report_unrecorded_payment(message, 'корзина изменилась после счёта')
+        return
+    if not items:
+        # Деньги уже списаны, а заказ не записан: нужен разбор вручную.
+        await report_unrecorded_payment(message, 'корзина пуста')
+        return
+    logger.info('Order paid: user_id=%s, total=%s, charge_id=%s',
+                message.from_user.id, payment.total_amount, payment.telegram_payment_charge_id)
+    await message.reply(f'Спасибо за заказ! Оплачено {payment.total_amount / 100} руб.')
+
 
+async def report_unrecorded_payment(message: types.Message, reason):
+    payment = message.successful_payment
+    logger.error('Payment without order (%s): user_id=%s, total=%s, charge_id=%s', reason,
+                 message.from_user.id, payment.total_amount, payment.telegram_payment_charge_id)
+    outbox.send(config.ADMIN_USER_ID, f'Оплата без заказа ({reason}): пользователь {message.from_user.id}, '
+                                      f'{payment.total_amount / 100} руб., платёж '
+                                      f'{payment.telegram_payment_charge_id}')
+    await message.reply('Оплата получена, но заказ не удалось оформить. Мы свяжемся с вами, '
+                        'чтобы уточнить заказ или вернуть деньги.')
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('delete_'))
-async def delete_burger(callback_query: types.CallbackQuery):
+
+@callbacks.route(DeleteCallback)
+async def delete_burger(callback_query: types.CallbackQuery, callback_data: DeleteCallback):
     await bot.answer_callback_query(callback_query.id)
 
-    data_parts = callback_query.data.split('_')
-    if len(data_parts) == 2 and data_parts[0] == 'delete' and data_parts[1].isdigit():
-        burger_id = int(data_parts[1])
-        user_id = callback_query.from_user.id
-        cart_items = await database.async_get_cart(user_id)
-        burger = next((b for b in cart_items if b[0] == burger_id), None)
-
-        if burger:
-            quantity = burger[4]
-            builder = InlineKeyboardBuilder()
-            for i in range(1, quantity + 1):
-                builder.add(InlineKeyboardButton(text=str(i), callback_data=f'remove_{burger_id}_{i}'))
-            builder.adjust(3)  
-
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=f'Сколько бургеров {burger[1]} вы хотите удалить?',
-                reply_markup=builder.as_markup()
-            )
-        else:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text='Бургер не найден в корзине.'
-            )
+    burger_id = callback_data.burger_id
+    lines, _ = await repository.get_cart_summary(callback_query.from_user.id)
+    burger = next((line for line in lines if line[0] == burger_id), None)
+
+    if burger:
+        quantity = burger[3]
+        builder = InlineKeyboardBuilder()
+        for i in range(1, quantity + 1):
+            builder.add(InlineKeyboardButton(text=str(i),
+                                             callback_data=RemoveCallback(burger_id=burger_id, quantity=i).pack()))
+        builder.adjust(3)
+
+        outbox.send(
+            callback_query.message.chat.id,
+            f'Сколько бургеров {burger[1]} вы хотите удалить?',
+            reply_markup=builder.as_markup()
+        )
     else:
-        await bot.send_message(
-            chat_id=callback_query.message.chat.id,
-            text='Ошибка: неверный формат данных.'
+        outbox.send(
+            callback_query.message.chat.id,
+            'Бургер не найден в корзине.'
         )
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('remove_'))
-async def remove_burger(callback_query: types.CallbackQuery):
+@callbacks.route(RemoveCallback)
+async def remove_burger(callback_query: types.CallbackQuery, callback_data: RemoveCallback):
     await bot.answer_callback_query(callback_query.id)
 
-    data_parts = callback_query.data.split('_')
-    if len(data_parts) == 3 and data_parts[0] == 'remove' and data_parts[1].isdigit() and data_parts[2].isdigit():
-        burger_id = int(data_parts[1])
-        quantity_to_remove = int(data_parts[2])
-        user_id = callback_query.from_user.id
-        cart_items = await database.async_get_cart(user_id)
-        burger = next((b for b in cart_items if b[0] == burger_id), None)
-
-        if burger:
-            quantity = burger[4]
-            if 0 < quantity_to_remove <= quantity:
-                await database.async_remove_from_cart(user_id, burger_id, quantity_to_remove)
-                await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text=f'Удалено {quantity_to_remove} бургеров {burger[1]}.'
-                )
-                await bot.send_message(callback_query.message.chat.id, 'Доступные команды:\n' + '\n'.join(commands))
-            else:
-                await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text='Неверное количество бургеров для удаления.'
-                )
-        else:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text='Бургер не найден в корзине.'
-            )
+    burger_id = callback_data.burger_id
+    quantity_to_remove = callback_data.quantity
+    user_id = callback_query.from_user.id
+
+    try:
+        if quantity_to_remove <= 0:
+            raise ValueError("Nothing to remove")
+        remaining = await repository.remove_from_cart(user_id, burger_id, quantity_to_remove)
+    except ValueError:
+        remaining = -1
+
+    if remaining is None:
+        outbox.send(
+            callback_query.message.chat.id,
+            'Бургер не найден в корзине.'
+        )
+    elif remaining < 0:
+        outbox.send(
+            callback_query.message.chat.id,
+            'Неверное количество бургеров для удаления.'
+        )
     else:
-        await bot.send_message(
-            chat_id=callback_query.message.chat.id,
-            text='Ошибка: неверный формат данных.'
+        burger = await catalog.get(burger_id)
+        burger_name = burger[1] if burger else ''
+        outbox.send(
+            callback_query.message.chat.id,
+            f'Удалено {quantity_to_remove} бургеров {burger_name}.'
         )
+        outbox.send(callback_query.message.chat.id, 'Доступные команды:\n' + '\n'.join(commands))
+
+
+@dp.startup()
+async def on_startup():
+    await repository.init_db()
+    await catalog.refresh()
+    if isinstance(storage, WriteBehindStorage):
+        storage.start()
+    if config.METRICS_ENABLED:
+        await metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+    # Прерванные рассылки ведёт только один процесс; очистку базы каждый
+    # делает для своих пользователей (см. configure_worker).
+    if worker_index == 0:
+        await broadcaster.resume(on_finish=report_broadcast)
+    compactor.start()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    # Хранилище FSM сбрасывает состояния раньше (Dispatcher регистрирует его
+    # закрытие первым), так что пул можно закрывать.
+    await compactor.close()
+    await broadcaster.close()
+    await quantity_edits.close()
+    await outbox.close()
+    await metrics.stop_server()
+    await repository.close()
 
 
 async def main():
     await dp.start_polling(bot)
 
 
-async def shutdown():
-    await bot.close()
-    await asyncio.sleep(0.1)
+def configure_worker(index, workers):
+    global worker_index
+    worker_index = index
+    # У каждого процесса свои метрики, поэтому и свой порт: METRICS_PORT + номер.
+    config.METRICS_PORT += index
+    compactor.shard = (index, workers)
+    if workers > 1:
+        outbox.limit_global_rate(config.OUTBOX_GLOBAL_RATE / workers)
+
+
+def user_shard(update: types.Update, shards):
+    # Все обновления пользователя попадают в один процесс: порядок, очередь
+    # пользователя и кэши процесса остаются корректными.
+    user = getattr(update.event, 'from_user', None)
+    return user.id % shards if user else 0
+
+
+async def process_update(update: types.Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception('Failed to process update %s', update.update_id)
+
+
+async def consume_updates(updates):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    try:
+        # Внутри try: если запуск упал (например, база заблокирована),
+        # процесс всё равно закроет то, что успел открыть, и завершится с
+        # ошибкой, а родитель запустит его заново (watch_workers).
+        await dp.emit_startup(bot=bot)
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            task = asyncio.create_task(process_update(types.Update.model_validate_json(raw, context={'bot': bot})))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+def run_worker(index, updates):
+    # Родительский процесс сам завершит работника, отправив None.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_worker(index, config.WORKERS)
+    asyncio.run(consume_updates(updates))
+
+
+def spawn_worker(index, updates):
+    context = multiprocessing.get_context('spawn')
+    worker = context.Process(target=run_worker, args=(index, updates), name=f'worker-{index}')
+    worker.start()
+    return worker
+
+
+async def watch_workers(workers, queues):
+    # Упавший работник перезапускается: иначе обновления его доли
+    # пользователей копились бы в очереди, которую никто не читает.
+    # Очередь остаётся той же, если работник завершился сам. Убитый сигналом
+    # мог умереть внутри queue.get() с захваченной блокировкой чтения, тогда
+    # очередь заменяется новой, а ещё не прочитанные обновления теряются.
+    while True:
+        await asyncio.sleep(1)
+        for index, worker in enumerate(workers):
+            if worker.is_alive():
+                continue
+            logger.error('Worker %d exited with code %s, restarting', index, worker.exitcode)
+            if worker.exitcode < 0:
+                queues[index].cancel_join_thread()
+                queues[index].close()
+                queues[index] = multiprocessing.get_context('spawn').Queue()
+            workers[index] = spawn_worker(index, queues[index])
+
+
+def dispatch_update(queues, update: types.Update, raw):
+    queues[user_shard(update, len(queues))].put(raw)
+
+
+async def fan_out_updates(queues):
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=config.POLLING_TIMEOUT,
+                                            allowed_updates=allowed_updates,
+                                            request_timeout=config.POLLING_TIMEOUT + 10)
+        except TelegramNetworkError as e:
+            logger.warning('getUpdates failed: %s', e)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            dispatch_update(queues, update, update.model_dump_json(exclude_unset=True))
+
+
+async def receive_webhook(queues):
+    # Принимающий процесс только проверяет секрет и раздаёт тело запроса
+    # работникам; отвечает Telegram сразу, не дожидаясь обработки.
+    async def handle(request: web.Request):
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret, config.WEBHOOK_SECRET):
+            return web.Response(status=401)
+        raw = await request.text()
+        try:
+            update = types.Update.model_validate_json(raw)
+        except ValueError:
+            return web.Response(status=400)
+        dispatch_update(queues, update, raw)
+        return web.Response()
+
+    await bot.set_webhook(
+        url=config.WEBHOOK_BASE_URL + config.WEBHOOK_PATH,
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    app = web.Application()
+    app.router.add_post(config.WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT).start()
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
-def atexit_handler():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(shutdown())
+async def supervise(receive, queues, workers):
+    watcher = asyncio.create_task(watch_workers(workers, queues))
+    try:
+        await receive(queues)
+    finally:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+        await bot.session.close()
+
+
+def run_workers(receive):
+    # Один процесс получает обновления (getUpdates или вебхук) и раздаёт их
+    # работникам по user_id; обрабатывают их WORKERS процессов.
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(config.WORKERS)]
+    workers = [spawn_worker(i, queue) for i, queue in enumerate(queues)]
+    # SIGTERM завершает приём так же, как Ctrl+C, чтобы работники дочистили очереди.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(supervise(receive, queues, workers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+
+def run_polling():
+    if config.WORKERS <= 1:
+        asyncio.run(main())
+        return
+    run_workers(fan_out_updates)
+
+
+def make_webhook_app():
+    app = web.Application()
+    # setup_application регистрируется первым, чтобы on_shutdown (и дочистка
+    # очереди исходящих) отработал до закрытия сессии бота обработчиком вебхука.
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=config.WEBHOOK_SECRET,
+        handle_in_background=True
+    ).register(app, path=config.WEBHOOK_PATH)
+    return app
+
+
+async def set_webhook():
+    await bot.set_webhook(
+        url=config.WEBHOOK_BASE_URL + config.WEBHOOK_PATH,
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    await bot.session.close()
+
+
+def run_webhook():
+    # Очередь пользователя, сбор нажатий +/- и кэш повторов живут в памяти
+    # процесса, поэтому несколько работников получают обновления не напрямую
+    # от Telegram, а через раздающий процесс, как в режиме polling.
+    if config.WORKERS > 1:
+        run_workers(receive_webhook)
+        return
+    asyncio.run(set_webhook())
+    configure_worker(0, 1)
+    web.run_app(make_webhook_app(), host=config.WEBHOOK_HOST, port=config.WEBHOOK_PORT)
 
 
 if __name__ == '__main__':
-    database.init_db()
-    atexit.register(atexit_handler)
-    asyncio.run(main())
+    if config.RUN_MODE == 'webhook':
+        run_webhook()
+    else:
+        run_polling()
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+
+import config
+import telegram_api
+from database import repository
+from outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    # Рассылки администратора. Получатели читаются порциями по
+    # BROADCAST_BATCH, каждая порция отправляется через общую HTTP-сессию
+    # telegram_api не более чем BROADCAST_CONCURRENCY запросами сразу
+    # (с ожиданием при 429), после порции прогресс пишется в broadcasts.
+    # Скорость рассылки - доля BROADCAST_SHARE общего лимита бота, и каждая
+    # отправка берёт токен из него же (Outbox.acquire): остаток лимита
+    # гарантированно остаётся ответам пользователям.
+    # Незавершённые рассылки продолжаются после перезапуска с сохранённого
+    # места; порция, прерванная на середине, будет отправлена повторно.
+
+    def __init__(self, outbox, batch_size=config.BROADCAST_BATCH, concurrency=config.BROADCAST_CONCURRENCY,
+                 share=config.BROADCAST_SHARE):
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.share = share
+        self._tasks = {}
+
+    async def start(self, text, on_finish=None):
+        broadcast_id = await repository.create_broadcast(text)
+        self._spawn(broadcast_id, text, 0, 0, 0, on_finish)
+        return broadcast_id
+
+    async def resume(self, on_finish=None):
+        for broadcast_id, text, last_user_id, sent, failed in await repository.get_unfinished_broadcasts():
+            logger.info('Resuming broadcast %s after user %s', broadcast_id, last_user_id)
+            self._spawn(broadcast_id, text, last_user_id, sent, failed, on_finish)
+
+    def _spawn(self, broadcast_id, text, last_user_id, sent, failed, on_finish):
+        task = asyncio.create_task(self._run(broadcast_id, text, last_user_id, sent, failed, on_finish))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id, text, last_user_id, sent, failed, on_finish):
+        started = time.perf_counter()
+        sent_now = 0
+        # Лимит процесса известен только после configure_worker, поэтому здесь.
+        rate = self.outbox.global_rate * self.share
+        bucket = TokenBucket(rate, rate)
+        bucket_lock = asyncio.Lock()
+
+        async def limiter():
+            async with bucket_lock:
+                await bucket.acquire()
+            await self.outbox.acquire()
+
+        try:
+            while True:
+                user_ids = await repository.get_recipients(last_user_id, self.batch_size)
+                if not user_ids:
+                    break
+                results = await telegram_api.send_many(user_ids, text, concurrency=self.concurrency,
+                                                       limiter=limiter)
+                delivered = sum(1 for result in results if result.get('ok'))
+                sent += delivered
+                sent_now += delivered
+                failed += len(results) - delivered
+                last_user_id = user_ids[-1]
+                await repository.save_broadcast_progress(broadcast_id, last_user_id, sent, failed)
+                logger.info('Broadcast %s: %d sent, %d failed, %.0f msg/s', broadcast_id, sent, failed,
+                            sent_now / (time.perf_counter() - started))
+            await repository.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, finished=True)
+        except asyncio.CancelledError:
+            logger.info('Broadcast %s paused after user %s', broadcast_id, last_user_id)
+            raise
+        except Exception:
+            logger.exception('Broadcast %s failed after user %s', broadcast_id, last_user_id)
+            return
+
+        elapsed = time.perf_counter() - started
+        logger.info('Broadcast %s finished: %d sent, %d failed in %.1f s', broadcast_id, sent, failed, elapsed)
+        if on_finish is not None:
+            on_finish(broadcast_id, sent, failed, sent_now / elapsed if elapsed else 0.0)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await telegram_api.close_session()
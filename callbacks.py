@@ -0,0 +1,91 @@
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters import Filter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery
+
+# Данные кнопок. Префиксы короткие: Telegram ограничивает callback_data 64 байтами.
+# Кнопки выбора количества несут текущее количество сами, поэтому обработчикам
+# не нужно хранить его на сервере.
+
+SEPARATOR = ':'  # Разделитель полей CallbackData по умолчанию.
+
+
+class BurgerCallback(CallbackData, prefix='b'):
+    burger_id: int
+
+
+class MenuPageCallback(CallbackData, prefix='m'):
+    # direction 'next' - бургеры с id больше burger_id, 'prev' - с меньшим.
+    direction: str
+    burger_id: int
+
+
+class IncreaseCallback(CallbackData, prefix='inc'):
+    burger_id: int
+    quantity: int
+
+
+class DecreaseCallback(CallbackData, prefix='dec'):
+    burger_id: int
+    quantity: int
+
+
+class QuantityCallback(CallbackData, prefix='qty'):
+    burger_id: int
+    quantity: int
+
+
+class AddToCartCallback(CallbackData, prefix='add'):
+    burger_id: int
+    quantity: int
+
+
+class DeleteCallback(CallbackData, prefix='del'):
+    burger_id: int
+
+
+class RemoveCallback(CallbackData, prefix='rm'):
+    burger_id: int
+    quantity: int
+
+
+class BuyCallback(CallbackData, prefix='buy'):
+    pass
+
+
+class InvoicePayload(CallbackData, prefix='order'):
+    # Не кнопка, а payload счёта: кому он выставлен, на какую сумму корзины
+    # (в копейках, без доставки) и отпечаток её состава (database.cart_digest).
+    # Проверяется при pre_checkout_query и при оплате.
+    user_id: int
+    total: int
+    cart: str
+
+
+class CallbackRouter(Filter):
+    # Один фильтр вместо цепочки: обработчик выбирается по префиксу словарём,
+    # а не перебором фильтров. Найденный обработчик и разобранные данные
+    # попадают в data как 'route' и 'callback_data'.
+
+    def __init__(self):
+        self._routes = {}
+
+    def route(self, factory):
+        def decorator(handler):
+            self._routes[factory.__prefix__] = (factory, CallableObject(handler))
+            return handler
+        return decorator
+
+    async def __call__(self, callback_query: CallbackQuery):
+        if not callback_query.data:
+            return False
+        prefix = callback_query.data.split(SEPARATOR, 1)[0]
+        route = self._routes.get(prefix)
+        if route is None:
+            return False
+        factory, handler = route
+        try:
+            callback_data = factory.unpack(callback_query.data)
+        except (TypeError, ValueError):
+            return False
+        return {'route': handler, 'callback_data': callback_data}
@@ -0,0 +1,81 @@
+import asyncio
+import bisect
+import logging
+import time
+
+import config
+from database import repository
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogCache:
+    # Меню меняется редко, поэтому держим его в памяти процесса.
+    # Изменения из этого процесса сбрасывают кэш сразу. Изменения из других
+    # процессов (catalog_tool.py, другие работники) видны по версии меню в
+    # таблице meta: раз в TTL сверяется только она, меню перечитывается,
+    # если версия изменилась (вместе с кэшем корзин репозитория). Правки
+    # прямым SQL без увеличения версии не видны.
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = 0
+        self.items = []
+        self._by_id = {}
+        self._ids = []
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    async def refresh(self):
+        # Версию читаем до меню: если меню успеют изменить между запросами,
+        # на следующей проверке версия не совпадёт и меню перечитается.
+        version = await repository.get_catalog_version()
+        if self._loaded_at is None or version != self.version:
+            if self._loaded_at is not None:
+                # Меню изменил другой процесс: кэшированные суммы корзин
+                # посчитаны по старым ценам.
+                repository.invalidate_carts()
+            burgers = await repository.get_burgers()
+            self.items = burgers
+            self._by_id = {burger[0]: burger for burger in burgers}
+            self._ids = [burger[0] for burger in burgers]
+            self.version = version
+            logger.info('Catalog loaded: %d burgers (version %d)', len(burgers), self.version)
+        self._loaded_at = time.monotonic()
+
+    async def _ensure_fresh(self):
+        if self._expired():
+            async with self._lock:
+                if self._expired():
+                    await self.refresh()
+
+    async def all(self):
+        await self._ensure_fresh()
+        return self.items
+
+    async def get(self, burger_id):
+        await self._ensure_fresh()
+        return self._by_id.get(burger_id)
+
+    async def page(self, after=None, before=None, size=config.MENU_PAGE_SIZE):
+        # Страница по ключу (id последнего показанного бургера), а не по
+        # смещению: удаление бургера не сдвигает соседние страницы.
+        # Возвращает (бургеры, есть ли предыдущая, есть ли следующая).
+        await self._ensure_fresh()
+        if before is not None:
+            end = bisect.bisect_left(self._ids, before)
+            start = max(end - size, 0)
+        else:
+            start = 0 if after is None else bisect.bisect_right(self._ids, after)
+            end = start + size
+        return self.items[start:end], start > 0, end < len(self.items)
+
+
+catalog = CatalogCache(config.CATALOG_TTL)
+repository.on_catalog_change.append(catalog.invalidate)
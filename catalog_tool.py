@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+
+from database import repository
+
+# Загрузка и выгрузка меню. Файл описывает меню целиком: строки с id или
+# совпадающим названием обновляют существующие бургеры, остальные
+# добавляются, а бургеры, которых нет в файле, удаляются. Изменения
+# применяются одной транзакцией, меняются только отличающиеся строки.
+#
+#   python catalog_tool.py import menu.csv --dry-run
+#   python catalog_tool.py import menu.json
+#   python catalog_tool.py export menu.csv
+#
+# CSV: заголовок id,name,description,price (id можно не заполнять).
+# JSON: список объектов с теми же полями.
+
+FIELDS = ('id', 'name', 'description', 'price')
+
+
+def read_rows(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.json'):
+            items = json.load(f)
+        else:
+            items = csv.DictReader(f)
+        for line, item in enumerate(items, 1):
+            try:
+                burger_id = item.get('id')
+                yield (
+                    int(burger_id) if burger_id not in (None, '') else None,
+                    item['name'].strip(),
+                    (item.get('description') or '').strip(),
+                    float(item['price'])
+                )
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                raise SystemExit(f'{path}: invalid row {line}: {item!r} ({e})')
+
+
+def diff_catalog(current, rows):
+    by_id = {burger[0]: tuple(burger) for burger in current}
+    by_name = {burger[1]: burger[0] for burger in current}
+    upserts = []
+    kept = set()
+    for burger_id, name, description, price in rows:
+        if burger_id is None:
+            burger_id = by_name.get(name)
+        if burger_id is not None:
+            if burger_id in kept:
+                raise SystemExit(f'Burger {burger_id} ({name}) appears twice')
+            kept.add(burger_id)
+        row = (burger_id, name, description, price)
+        if by_id.get(burger_id) != row:
+            upserts.append(row)
+    deleted_ids = [burger_id for burger_id in by_id if burger_id not in kept]
+    return upserts, deleted_ids
+
+
+async def import_catalog(path, dry_run):
+    await repository.init_db()
+    current = await repository.get_burgers()
+    upserts, deleted_ids = diff_catalog(current, read_rows(path))
+    current_ids = {burger[0] for burger in current}
+    added = sum(1 for row in upserts if row[0] not in current_ids)
+    print(f'{added} to add, {len(upserts) - added} to update, {len(deleted_ids)} to delete')
+    if dry_run or not (upserts or deleted_ids):
+        return
+    version = await repository.apply_catalog_changes(upserts, deleted_ids)
+    print(f'Catalog version {version}')
+
+
+async def export_catalog(path):
+    burgers = [dict(zip(FIELDS, burger)) for burger in await repository.get_burgers()]
+    f = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+    try:
+        if path.endswith('.json'):
+            json.dump(burgers, f, ensure_ascii=False, indent=2)
+        else:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(burgers)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    if path != '-':
+        print(f'{len(burgers)} burgers written to {os.path.abspath(path)}')
+
+
+async def run(args):
+    try:
+        if args.command == 'import':
+            await import_catalog(args.path, args.dry_run)
+        else:
+            await export_catalog(args.path)
+    finally:
+        await repository.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import or export the burger menu')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='replace the menu with the contents of a CSV/JSON file')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--dry-run', action='store_true', help='only print what would change')
+    export_parser = subparsers.add_parser('export', help='write the menu to a CSV/JSON file ("-" for stdout)')
+    export_parser.add_argument('path')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import time
+
+import config
+from database import repository
+
+logger = logging.getLogger(__name__)
+
+LEGACY_TABLES = ('user_quantities', 'user_remove_states')
+
+
+class Compactor:
+    # Фоновая очистка базы в цикле событий бота: раз в interval секунд
+    # удаляет брошенные корзины и давно не менявшиеся состояния небольшими
+    # транзакциями (между ними запись успевают сделать обработчики), затем
+    # возвращает освободившиеся страницы через incremental_vacuum.
+    # При нескольких процессах каждый чистит корзины своих пользователей
+    # (shard, см. Repository.delete_stale_carts) и сбрасывает их в своём
+    # кэше; остальное делает процесс с номером 0.
+
+    def __init__(self, interval=config.COMPACTION_INTERVAL, batch_size=config.COMPACTION_BATCH,
+                 cart_ttl=config.CART_TTL, state_ttl=config.STATE_TTL, vacuum_pages=config.COMPACTION_VACUUM_PAGES):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.cart_ttl = cart_ttl
+        self.state_ttl = state_ttl
+        self.vacuum_pages = vacuum_pages
+        self.shard = (0, 1)
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception('Compaction failed')
+
+    async def _drain(self, delete, *args, **kwargs):
+        total = 0
+        while True:
+            deleted = await delete(*args, self.batch_size, **kwargs)
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+            await asyncio.sleep(0)
+
+    async def run_once(self):
+        started = time.perf_counter()
+        now = int(time.time())
+        carts = await self._drain(repository.delete_stale_carts, now - self.cart_ttl, shard=self.shard)
+        states = legacy = pages = 0
+        if self.shard[0] == 0:
+            states = await self._drain(repository.delete_stale_user_states, now - self.state_ttl)
+            for table in LEGACY_TABLES:
+                legacy += await self._drain(repository.delete_legacy_rows, table)
+            pages = await repository.incremental_vacuum(self.vacuum_pages)
+        logger.info('Compaction: %d carts, %d user states, %d legacy rows deleted, %d pages freed in %.2f s',
+                    carts, states, legacy, pages, time.perf_counter() - started)
+        return carts, states, legacy, pages
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -5,3 +5,66 @@ TIME_MACHINE_IMAGE_URL = 'https://example.com/time_machine.jpg'
 ADMIN_USER_ID = 1940359844  # ID администратора.
 DATABASE_PATH = 'burgers.db'
 GITLAB_ACCESS_TOKEN = 'YOUR_KEY'
+DB_POOL_READERS = 4  # Соединений на чтение в пуле; запись всегда идёт через одно соединение.
+CATALOG_TTL = 10  # Секунд между проверками версии меню в базе (меню перечитывается, только если она изменилась).
+KEYBOARD_CACHE_SIZE = 1024  # Сколько клавиатур выбора количества держать в LRU-кэше.
+FSM_FLUSH_INTERVAL = 1.0  # Как часто (в секундах) состояния пользователей сбрасываются в базу.
+FSM_FLUSH_BATCH = 500  # Максимум пользователей в одной транзакции сброса.
+FSM_CACHE_SIZE = 100000  # Сколько пользователей держать в памяти при STATE_BACKEND = 'memory'.
+# Применяются к каждому новому соединению с SQLite. WAL позволяет читать меню и
+# корзины во время записи состояний, synchronous=NORMAL в режиме WAL не теряет
+# целостность базы, а только последние транзакции при отключении питания.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,  # В KiB, т.е. ~16 МБ на соединение.
+    'mmap_size': 64 * 1024 * 1024,
+    'busy_timeout': 5000,  # мс ожидания блокировки вместо мгновенного "database is locked".
+    'temp_store': 'MEMORY',
+}
+SQLITE_STATEMENT_CACHE = 256  # Подготовленных запросов, кэшируемых на соединение.
+RUN_MODE = 'polling'  # 'polling' или 'webhook'.
+WEBHOOK_BASE_URL = 'https://example.com'  # Публичный HTTPS-адрес, на который Telegram шлёт обновления.
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET = 'YOUR_WEBHOOK_SECRET'  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token.
+TELEGRAM_API_URL = 'https://api.telegram.org'  # Можно указать локальный fake_telegram.py для тестов.
+TELEGRAM_HTTP_POOL_SIZE = 100  # Одновременных HTTP-соединений к Bot API.
+TELEGRAM_SEND_CONCURRENCY = 25  # Сколько сообщений send_many отправляет параллельно.
+TELEGRAM_MAX_RETRIES = 3  # Повторов после ответа 429 Too Many Requests.
+OUTBOX_GLOBAL_RATE = 30  # Сообщений в секунду на всего бота (лимит Telegram).
+OUTBOX_CHAT_RATE = 1  # Сообщений в секунду в один чат.
+OUTBOX_CHAT_BURST = 3  # Сколько сообщений в чат можно отправить подряд без ожидания.
+OUTBOX_DRAIN_TIMEOUT = 10  # Секунд на отправку оставшихся сообщений при остановке.
+CART_CACHE_SIZE = 10000  # Сколько сводок корзин держать в памяти.
+METRICS_ENABLED = False  # Метрики обработчиков, БД и Bot API в формате Prometheus.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100  # При нескольких процессах-обработчиках: 9100, 9101, ...
+USER_QUEUE_SIZE = 20  # Сколько обновлений одного пользователя может ждать очереди; лишние отбрасываются.
+QUANTITY_EDIT_DELAY = 0.4  # Секунд, за которые нажатия +/- собираются в одну правку клавиатуры.
+QUANTITY_EDIT_CACHE_SIZE = 10000  # Сколько последних отправленных количеств на клавиатурах помнить.
+STATE_BACKEND = 'memory'  # Где хранить состояния FSM: 'memory' (кэш с отложенной записью), 'sqlite' или 'redis'.
+REDIS_URL = 'redis://localhost:6379/0'  # Для STATE_BACKEND = 'redis'.
+WORKERS = 1  # Процессов-обработчиков (polling и webhook); обновления раздаются им по user_id.
+POLLING_TIMEOUT = 30  # Секунд long polling в getUpdates.
+MENU_PAGE_SIZE = 8  # Бургеров на одной странице меню.
+SEARCH_RESULTS_LIMIT = 20  # Сколько бургеров показывать в inline-поиске.
+SHIPPING_COUNTRIES = ('RU',)  # Коды стран (ISO 3166-1 alpha-2), куда есть доставка.
+SHIPPING_RATES = [  # (id, название, цена в копейках)
+    ('courier', 'Курьер', 19900),
+    ('pickup', 'Самовывоз', 0),
+]
+BROADCAST_BATCH = 500  # Получателей рассылки, читаемых из базы за раз; после каждой порции сохраняется прогресс.
+BROADCAST_CONCURRENCY = 25  # Одновременных отправок в рассылке.
+BROADCAST_SHARE = 0.7  # Доля OUTBOX_GLOBAL_RATE для рассылок; остальное остаётся ответам пользователям.
+STATS_MAX_HOURS = 24 * 31  # Самый длинный период для /stats.
+STATS_TOP_BURGERS = 10  # Сколько бургеров показывать в /stats.
+CART_TTL = 7 * 24 * 3600  # Секунд без изменений, после которых корзина считается брошенной и удаляется.
+STATE_TTL = 30 * 24 * 3600  # Секунд без активности, после которых удаляется состояние пользователя.
+COMPACTION_INTERVAL = 3600  # Как часто (в секундах) запускается очистка базы.
+COMPACTION_BATCH = 500  # Корзин или строк, удаляемых одной транзакцией при очистке.
+COMPACTION_VACUUM_PAGES = 2000  # Сколько свободных страниц возвращать системе за один запуск.
+IDEMPOTENCY_CACHE_SIZE = 100000  # Сколько последних update_id и нажатий помнить для отсева дублей.
+IDEMPOTENCY_UPDATE_TTL = 600  # Секунд, в течение которых повторно доставленное обновление пропускается.
+IDEMPOTENCY_TAP_TTL = 5  # Секунд, в течение которых повторное нажатие "В корзину", "Удалить", "Купить" игнорируется.
@@ -1,245 +1,640 @@
-import sqlite3
-import aiosqlite
-
-def get_connection():
-    conn = sqlite3.connect('burgers.db')
-    return conn
-
-async def async_get_connection():
-    return await aiosqlite.connect('burgers.db')
-
-def init_db():
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS burgers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT NOT NULL,
-                price REAL NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cart (
-                user_id INTEGER NOT NULL,
-                burger_id INTEGER NOT NULL,
-                quantity INTEGER NOT NULL DEFAULT 1,
-                FOREIGN KEY (burger_id) REFERENCES burgers (id)
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_states (
-                user_id INTEGER PRIMARY KEY,
-                state TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_quantities (
-                user_id INTEGER PRIMARY KEY,
-                quantity INTEGER NOT NULL DEFAULT 1
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_remove_states (
-                user_id INTEGER PRIMARY KEY,
-                burger_id INTEGER,
-                quantity INTEGER
-            )
-        ''')
-        conn.commit()
-
-def get_burgers():
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM burgers')
-        burgers = cursor.fetchall()
-        print(f"Burgers fetched: {burgers}")
-        return burgers
-
-def remove_burger(burger_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM burgers WHERE id = ?', (burger_id,))
-        conn.commit()
-
-def add_to_cart(user_id, burger_id, quantity):
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO cart (user_id, burger_id, quantity) VALUES (?, ?, ?)',
-                           (user_id, burger_id, quantity))
-            conn.commit()
-            print(f"Added to cart: user_id={user_id}, burger_id={burger_id}, quantity={quantity}")
-    except Exception as e:
-        print(f"Error adding to cart: {e}")
-
-def get_cart(user_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT b.id, b.name, b.description, b.price, c.quantity
-            FROM cart c
-            JOIN burgers b ON c.burger_id = b.id
-            WHERE c.user_id = ?
-        ''', (user_id,))
-        cart_items = cursor.fetchall()
-        return cart_items
-
-def remove_from_cart(user_id, burger_id, quantity):
-    if not isinstance(user_id, int) or not isinstance(burger_id, int) or not isinstance(quantity, int):
-        raise ValueError("Invalid data format")
-
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT quantity FROM cart WHERE user_id = ? AND burger_id = ?', (user_id, burger_id))
-        result = cursor.fetchone()
-        if result:
-            current_quantity = result[0]
-            new_quantity = max(current_quantity - quantity, 0)
-            if new_quantity == 0:
-                cursor.execute('DELETE FROM cart WHERE user_id = ? AND burger_id = ?', (user_id, burger_id))
-            else:
-                cursor.execute('UPDATE cart SET quantity = ? WHERE user_id = ? AND burger_id = ?',
-                               (new_quantity, user_id, burger_id))
-        conn.commit()
-        print(f"Removed from cart: user_id={user_id}, burger_id={burger_id}, quantity={quantity}")
-
-def save_user_state(user_id, state):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('REPLACE INTO user_states (user_id, state) VALUES (?, ?)', (user_id, state))
-        conn.commit()
-
-def get_user_state(user_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT state FROM user_states WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-
-def save_user_quantity(user_id, quantity):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('REPLACE INTO user_quantities (user_id, quantity) VALUES (?, ?)', (user_id, quantity))
-        conn.commit()
-
-def get_user_quantity(user_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT quantity FROM user_quantities WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-
-def save_user_remove_burger_id(user_id, burger_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('REPLACE INTO user_remove_states (user_id, burger_id) VALUES (?, ?)', (user_id, burger_id))
-        conn.commit()
-
-def get_user_remove_burger_id(user_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT burger_id FROM user_remove_states WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-
-def save_user_remove_quantity(user_id, quantity):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('REPLACE INTO user_remove_states (user_id, quantity) VALUES (?, ?)', (user_id, quantity))
-        conn.commit()
-
-def get_user_remove_quantity(user_id):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT quantity FROM user_remove_states WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-
-# Асинхронные функции для работы с базой данных
-
-async def async_remove_from_cart(user_id, burger_id, quantity):
-    async with aiosqlite.connect('burgers.db') as db:
-        cursor = await db.execute('SELECT quantity FROM cart WHERE user_id = ? AND burger_id = ?', (user_id, burger_id))
-        result = await cursor.fetchone()
-        if result:
-            current_quantity = result[0]
-            new_quantity = max(current_quantity - quantity, 0)
-            if new_quantity == 0:
-                await db.execute('DELETE FROM cart WHERE user_id = ? AND burger_id = ?', (user_id, burger_id))
-            else:
-                await db.execute('UPDATE cart SET quantity = ? WHERE user_id = ? AND burger_id = ?',
-                                 (new_quantity, user_id, burger_id))
-        await db.commit()
-
-async def async_add_to_cart(user_id, burger_id, quantity):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('INSERT INTO cart (user_id, burger_id, quantity) VALUES (?, ?, ?)',
-                         (user_id, burger_id, quantity))
-        await db.commit()
-
-async def async_get_cart(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        cursor = await db.execute('''
-            SELECT b.id, b.name, b.description, b.price, c.quantity
-            FROM cart c
-            JOIN burgers b ON c.burger_id = b.id
-            WHERE c.user_id = ?
-        ''', (user_id,))
-        cart_items = await cursor.fetchall()
-        return cart_items
-
-async def async_get_burgers():
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT * FROM burgers') as cursor:
-            burgers = await cursor.fetchall()
-            return burgers
-
-async def async_remove_burger(burger_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('DELETE FROM burgers WHERE id = ?', (burger_id,))
-        await db.commit()
-
-async def async_save_user_state(user_id, state):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('REPLACE INTO user_states (user_id, state) VALUES (?, ?)', (user_id, state))
-        await db.commit()
-
-async def async_get_user_state(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT state FROM user_states WHERE user_id = ?', (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else None
-
-async def async_save_user_quantity(user_id, quantity):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('REPLACE INTO user_quantities (user_id, quantity) VALUES (?, ?)', (user_id, quantity))
-        await db.commit()
-
-async def async_get_user_quantity(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT quantity FROM user_quantities WHERE user_id = ?', (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else None
-
-async def async_save_user_remove_burger_id(user_id, burger_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('REPLACE INTO user_remove_states (user_id, burger_id) VALUES (?, ?)', (user_id, burger_id))
-        await db.commit()
-
-async def async_get_user_remove_burger_id(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT burger_id FROM user_remove_states WHERE user_id = ?', (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else None
-
-async def async_save_user_remove_quantity(user_id, quantity):
-    async with aiosqlite.connect('burgers.db') as db:
-        await db.execute('REPLACE INTO user_remove_states (user_id, quantity) VALUES (?, ?)', (user_id, quantity))
-        await db.commit()
-
-async def async_get_user_remove_quantity(user_id):
-    async with aiosqlite.connect('burgers.db') as db:
-        async with db.execute('SELECT quantity FROM user_remove_states WHERE user_id = ?', (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else None
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import time
+from collections import OrderedDict
+import config
+from db_pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# updated_at (unix-время) в cart и user_states - последнее изменение строки;
+# по нему фоновая очистка (compaction.py) удаляет брошенные корзины и состояния.
+ADD_TO_CART_SQL = '''
+    INSERT INTO cart (user_id, burger_id, quantity, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, burger_id) DO UPDATE SET
+        quantity = quantity + excluded.quantity, updated_at = excluded.updated_at
+'''
+
+# Списание и удаление опустевшей позиции идут в одной транзакции. Возвращается
+# оставшееся количество или None, если бургера в корзине нет; если в корзине
+# меньше, чем просят удалить, бросается ValueError и ничего не меняется.
+REMOVE_FROM_CART_SQL = '''
+    UPDATE cart SET quantity = quantity - ?, updated_at = ?
+    WHERE user_id = ? AND burger_id = ? AND quantity >= ?
+    RETURNING quantity
+'''
+
+# Строки корзины (burger_id, name, price, quantity) и итог в копейках одним
+# запросом: итог считается оконной функцией по тем же строкам.
+CART_SUMMARY_SQL = '''
+    SELECT b.id, b.name, b.price, c.quantity,
+           SUM(CAST(ROUND(b.price * 100) AS INTEGER) * c.quantity) OVER () AS total
+    FROM cart c
+    JOIN burgers b ON c.burger_id = b.id
+    WHERE c.user_id = ?
+    ORDER BY b.id
+'''
+
+# Почасовые счётчики для /stats (hour = unix-время // 3600). Обновляются в тех
+# же транзакциях, что и корзина, поэтому отчёт читает только нужные часы,
+# а не историю корзин и заказов.
+COUNT_ADDED_SQL = '''
+    INSERT INTO sales_hourly (hour, burger_id, added) VALUES (?, ?, ?)
+    ON CONFLICT (hour, burger_id) DO UPDATE SET added = added + excluded.added
+'''
+
+COUNT_REMOVED_SQL = '''
+    INSERT INTO sales_hourly (hour, burger_id, removed) VALUES (?, ?, ?)
+    ON CONFLICT (hour, burger_id) DO UPDATE SET removed = removed + excluded.removed
+'''
+
+COUNT_ORDERED_SQL = '''
+    INSERT INTO sales_hourly (hour, burger_id, ordered, revenue)
+    SELECT ?, c.burger_id, c.quantity, CAST(ROUND(b.price * 100) AS INTEGER) * c.quantity
+    FROM cart c
+    JOIN burgers b ON c.burger_id = b.id
+    WHERE c.user_id = ?
+    ON CONFLICT (hour, burger_id) DO UPDATE SET
+        ordered = ordered + excluded.ordered, revenue = revenue + excluded.revenue
+'''
+
+# revenue в orders_hourly - оплаченная сумма (с доставкой), в sales_hourly -
+# стоимость бургеров.
+COUNT_ORDER_SQL = '''
+    INSERT INTO orders_hourly (hour, orders, revenue) VALUES (?, 1, ?)
+    ON CONFLICT (hour) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue
+'''
+
+# users - все, кто когда-либо писал боту (получатели рассылок); в отличие от
+# user_states, строки отсюда не удаляются при очистке.
+TOUCH_USER_SQL = '''
+    INSERT INTO users (user_id, last_active) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET last_active = excluded.last_active
+'''
+
+UPSERT_BURGER_SQL = '''
+    INSERT INTO burgers (id, name, description, price) VALUES (?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        name = excluded.name, description = excluded.description, price = excluded.price
+'''
+
+# Версия меню растёт при каждом изменении burgers; кэши сравнивают её вместо
+# перечитывания всей таблицы.
+BUMP_CATALOG_VERSION_SQL = '''
+    INSERT INTO meta (key, value) VALUES ('catalog_version', 1)
+    ON CONFLICT (key) DO UPDATE SET value = value + 1
+'''
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS burgers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT NOT NULL,
+        price REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS cart (
+        user_id INTEGER NOT NULL,
+        burger_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        FOREIGN KEY (burger_id) REFERENCES burgers (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_states (
+        user_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_quantities (
+        user_id INTEGER PRIMARY KEY,
+        quantity INTEGER NOT NULL DEFAULT 1
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_remove_states (
+        user_id INTEGER PRIMARY KEY,
+        burger_id INTEGER,
+        quantity INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        burger_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        address TEXT NOT NULL,
+        city TEXT NOT NULL,
+        postal_code TEXT NOT NULL,
+        email TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        FOREIGN KEY (burger_id) REFERENCES burgers (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        last_active INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        finished INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS sales_hourly (
+        hour INTEGER NOT NULL,
+        burger_id INTEGER NOT NULL,
+        added INTEGER NOT NULL DEFAULT 0,
+        removed INTEGER NOT NULL DEFAULT 0,
+        ordered INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (hour, burger_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS orders_hourly (
+        hour INTEGER PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''',
+]
+
+# Миграции схемы. Номер последней применённой хранится в PRAGMA user_version,
+# новые миграции добавляются только в конец списка.
+
+async def _add_user_state_data(db):
+    async with db.execute('PRAGMA table_info(user_states)') as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if 'data' not in columns:
+        await db.execute("ALTER TABLE user_states ADD COLUMN data TEXT NOT NULL DEFAULT '{}'")
+
+async def _add_cart_key(db):
+    # Сливаем дубли (user_id, burger_id) в одну строку, иначе уникальный индекс не создать.
+    await db.execute('''
+        UPDATE cart SET quantity = (
+            SELECT SUM(c.quantity) FROM cart c
+            WHERE c.user_id = cart.user_id AND c.burger_id = cart.burger_id
+        )
+        WHERE rowid IN (SELECT MIN(rowid) FROM cart GROUP BY user_id, burger_id)
+    ''')
+    await db.execute('DELETE FROM cart WHERE rowid NOT IN (SELECT MIN(rowid) FROM cart GROUP BY user_id, burger_id)')
+    await db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_user_burger ON cart (user_id, burger_id)')
+
+async def _add_burgers_search(db):
+    # Полнотекстовый индекс по названию и описанию. Таблица внешнего
+    # содержимого хранит только индекс, данные берутся из burgers;
+    # триггеры поддерживают индекс при любых изменениях burgers.
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS burgers_fts USING fts5(
+            name, description, content='burgers', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS burgers_fts_insert AFTER INSERT ON burgers BEGIN
+            INSERT INTO burgers_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS burgers_fts_delete AFTER DELETE ON burgers BEGIN
+            INSERT INTO burgers_fts (burgers_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS burgers_fts_update AFTER UPDATE ON burgers BEGIN
+            INSERT INTO burgers_fts (burgers_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO burgers_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    await db.execute("INSERT INTO burgers_fts (burgers_fts) VALUES ('rebuild')")
+
+async def _add_activity_tracking(db):
+    # Существующим строкам ставим текущее время, чтобы они не удалились при
+    # первой же очистке, а users заполняем всеми известными пользователями.
+    now = int(time.time())
+    for table in ('cart', 'user_states'):
+        await db.execute(f'ALTER TABLE {table} ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0')
+        await db.execute(f'UPDATE {table} SET updated_at = ?', (now,))
+        await db.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_updated_at ON {table} (updated_at)')
+    await db.execute('''
+        INSERT OR IGNORE INTO users (user_id, last_active)
+        SELECT user_id, ? FROM user_states UNION SELECT user_id, ? FROM cart
+    ''', (now, now))
+
+MIGRATIONS = [
+    _add_user_state_data,
+    _add_cart_key,
+    _add_burgers_search,
+    _add_activity_tracking,
+]
+
+
+def current_hour():
+    return int(time.time()) // 3600
+
+
+def cart_digest(lines):
+    # Отпечаток состава корзины (бургер, цена в копейках, количество) для
+    # payload счёта: по нему при оплате видно, что корзина та же, что в счёте.
+    items = sorted((line[0], round(line[2] * 100), line[3]) for line in lines)
+    return hashlib.sha1(repr(items).encode()).hexdigest()[:16]
+
+
+class Repository:
+    # Единственная точка доступа к базе. Соединения берутся из пула, который
+    # открывается при первом обращении (или явно через open()) в текущем цикле событий.
+
+    def __init__(self, path=None, readers=None, pragmas=None, statement_cache=None):
+        self.path = path
+        self.readers = readers
+        self.pragmas = pragmas
+        self.statement_cache = statement_cache
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+        # Колбэки, вызываемые после изменения таблицы burgers (сброс кэшей меню).
+        self.on_catalog_change = []
+        # Сводки корзин по user_id (LRU). Сбрасываются при изменении корзины или меню.
+        # Счётчик сбросов не даёт запросу, начатому до записи, положить в кэш старые данные.
+        self._cart_cache = OrderedDict()
+        self._cart_epoch = 0
+
+    async def open(self):
+        async with self._pool_lock:
+            if self._pool is None:
+                pool = ConnectionPool(
+                    self.path or config.DATABASE_PATH,
+                    config.DB_POOL_READERS if self.readers is None else self.readers,
+                    config.SQLITE_PRAGMAS if self.pragmas is None else self.pragmas,
+                    config.SQLITE_STATEMENT_CACHE if self.statement_cache is None else self.statement_cache
+                )
+                await pool.open()
+                self._pool = pool
+        return self._pool
+
+    async def close(self):
+        async with self._pool_lock:
+            if self._pool is not None:
+                await self._pool.close()
+                self._pool = None
+
+    @contextlib.asynccontextmanager
+    async def reader(self):
+        pool = self._pool or await self.open()
+        async with pool.reader() as db:
+            yield db
+
+    @contextlib.asynccontextmanager
+    async def writer(self):
+        pool = self._pool or await self.open()
+        async with pool.writer() as db:
+            yield db
+
+    async def init_db(self):
+        async with self.writer() as db:
+            for statement in SCHEMA:
+                await db.execute(statement)
+        # Каждая миграция в своей транзакции; BEGIN IMMEDIATE и чтение версии
+        # внутри неё не дают двум процессам применить одну миграцию дважды.
+        while True:
+            async with self.writer() as db:
+                await db.execute('BEGIN IMMEDIATE')
+                async with db.execute('PRAGMA user_version') as cursor:
+                    version = (await cursor.fetchone())[0]
+                if version >= len(MIGRATIONS):
+                    break
+                await MIGRATIONS[version](db)
+                await db.execute(f'PRAGMA user_version = {version + 1}')
+            logger.info('Applied migration %d: %s', version + 1, MIGRATIONS[version].__name__)
+        # Без auto_vacuum = INCREMENTAL освобождённые очисткой страницы не
+        # возвращаются системе. Режим включается один раз полным VACUUM; он не
+        # работает внутри транзакции, поэтому это не миграция, и выполняется он
+        # при запуске, пока база не обслуживает пользователей.
+        async with self.writer() as db:
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                mode = (await cursor.fetchone())[0]
+            if mode != 2:
+                logger.info('Enabling incremental auto_vacuum (one-time VACUUM)')
+                await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                await db.execute('VACUUM')
+
+    def invalidate_carts(self):
+        # Суммы корзин считаются по ценам меню, поэтому при смене меню
+        # (в том числе из другого процесса) сбрасываются все сразу.
+        self._cart_epoch += 1
+        self._cart_cache.clear()
+
+    def _notify_catalog_change(self):
+        self.invalidate_carts()
+        for callback in self.on_catalog_change:
+            callback()
+
+    def _invalidate_cart(self, user_id):
+        self._cart_epoch += 1
+        self._cart_cache.pop(user_id, None)
+
+    async def get_burgers(self):
+        async with self.reader() as db:
+            async with db.execute('SELECT * FROM burgers ORDER BY id') as cursor:
+                return await cursor.fetchall()
+
+    async def get_catalog_version(self):
+        async with self.reader() as db:
+            async with db.execute("SELECT value FROM meta WHERE key = 'catalog_version'") as cursor:
+                result = await cursor.fetchone()
+                return result[0] if result else 0
+
+    async def search_burgers(self, query, limit):
+        # Каждое слово запроса ищется как начало слова: "чиз" найдёт "Чизбургер",
+        # "бургер кур" - бургеры, где есть оба слова.
+        words = [word.replace('"', '""') for word in query.split()]
+        if not words:
+            return []
+        match = ' '.join(f'"{word}"*' for word in words)
+        async with self.reader() as db:
+            async with db.execute('''
+                SELECT b.* FROM burgers_fts f
+                JOIN burgers b ON b.id = f.rowid
+                WHERE burgers_fts MATCH ?
+                ORDER BY f.rank
+                LIMIT ?
+            ''', (match, limit)) as cursor:
+                return await cursor.fetchall()
+
+    async def remove_burger(self, burger_id):
+        async with self.writer() as db:
+            await db.execute('DELETE FROM burgers WHERE id = ?', (burger_id,))
+            await db.execute(BUMP_CATALOG_VERSION_SQL)
+        self._notify_catalog_change()
+
+    async def apply_catalog_changes(self, upserts, deleted_ids):
+        # upserts - строки (id, name, description, price); id = None добавляет новый бургер.
+        # Всё применяется одной транзакцией вместе с увеличением версии меню.
+        async with self.writer() as db:
+            await db.executemany(UPSERT_BURGER_SQL, upserts)
+            await db.executemany('DELETE FROM burgers WHERE id = ?', [(burger_id,) for burger_id in deleted_ids])
+            await db.execute(BUMP_CATALOG_VERSION_SQL)
+            async with db.execute("SELECT value FROM meta WHERE key = 'catalog_version'") as cursor:
+                version = (await cursor.fetchone())[0]
+        self._notify_catalog_change()
+        return version
+
+    async def add_to_cart(self, user_id, burger_id, quantity):
+        async with self.writer() as db:
+            await db.execute(ADD_TO_CART_SQL, (user_id, burger_id, quantity, int(time.time())))
+            await db.execute(COUNT_ADDED_SQL, (current_hour(), burger_id, quantity))
+        self._invalidate_cart(user_id)
+        logger.debug('Added to cart: user_id=%s, burger_id=%s, quantity=%s', user_id, burger_id, quantity)
+
+    async def remove_from_cart(self, user_id, burger_id, quantity):
+        if not isinstance(user_id, int) or not isinstance(burger_id, int) or not isinstance(quantity, int):
+            raise ValueError("Invalid data format")
+
+        try:
+            async with self.writer() as db:
+                async with db.execute(REMOVE_FROM_CART_SQL,
+                                      (quantity, int(time.time()), user_id, burger_id, quantity)) as cursor:
+                    result = await cursor.fetchone()
+                if result is None:
+                    async with db.execute('SELECT 1 FROM cart WHERE user_id = ? AND burger_id = ?',
+                                          (user_id, burger_id)) as cursor:
+                        if await cursor.fetchone():
+                            raise ValueError("Not enough items in cart")
+                    return None
+                if result[0] == 0:
+                    await db.execute('DELETE FROM cart WHERE user_id = ? AND burger_id = ? AND quantity = 0',
+                                     (user_id, burger_id))
+                await db.execute(COUNT_REMOVED_SQL, (current_hour(), burger_id, quantity))
+                logger.debug('Removed from cart: user_id=%s, burger_id=%s, quantity=%s',
+                             user_id, burger_id, quantity)
+                return result[0]
+        finally:
+            self._invalidate_cart(user_id)
+
+    async def get_cart_summary(self, user_id, cached=True):
+        # cached=False - прочитать корзину из базы, минуя кэш (перед оплатой).
+        summary = self._cart_cache.get(user_id) if cached else None
+        if summary is not None:
+            self._cart_cache.move_to_end(user_id)
+            return summary
+
+        epoch = self._cart_epoch
+        async with self.reader() as db:
+            async with db.execute(CART_SUMMARY_SQL, (user_id,)) as cursor:
+                rows = await cursor.fetchall()
+        lines = tuple(row[:4] for row in rows)
+        summary = (lines, rows[0][4] if rows else 0)
+
+        if epoch == self._cart_epoch:
+            self._cart_cache[user_id] = summary
+            if len(self._cart_cache) > config.CART_CACHE_SIZE:
+                self._cart_cache.popitem(last=False)
+        return summary
+
+    async def create_order(self, user_id, address, city, postal_code, email, phone, cart=None, paid=None):
+        # Корзина переносится в orders и очищается одной транзакцией.
+        # Возвращает число позиций заказа; 0 - корзина уже пуста, None - она
+        # не совпадает с отпечатком cart из счёта. В обоих случаях ни заказ,
+        # ни счётчики /stats не записаны, корзина не меняется.
+        # paid - списанная сумма в копейках; без неё в выручку идёт сумма корзины.
+        try:
+            async with self.writer() as db:
+                async with db.execute(CART_SUMMARY_SQL, (user_id,)) as cursor:
+                    lines = await cursor.fetchall()
+                if not lines:
+                    return 0
+                if cart is not None and cart_digest(lines) != cart:
+                    return None
+                hour = current_hour()
+                await db.execute(COUNT_ORDER_SQL, (hour, lines[0][4] if paid is None else paid))
+                await db.execute(COUNT_ORDERED_SQL, (hour, user_id))
+                cursor = await db.execute('''
+                    INSERT INTO orders (user_id, burger_id, quantity, address, city, postal_code, email, phone)
+                    SELECT user_id, burger_id, quantity, ?, ?, ?, ?, ? FROM cart WHERE user_id = ?
+                ''', (address, city, postal_code, email, phone, user_id))
+                await db.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
+                return cursor.rowcount
+        finally:
+            self._invalidate_cart(user_id)
+
+    async def get_sales_stats(self, since_hour):
+        # Возвращает (заказы, выручка в копейках, строки по бургерам
+        # (burger_id, added, removed, ordered, revenue) по убыванию заказанного).
+        async with self.reader() as db:
+            async with db.execute('SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(revenue), 0) FROM orders_hourly '
+                                  'WHERE hour >= ?', (since_hour,)) as cursor:
+                orders, revenue = await cursor.fetchone()
+            async with db.execute('''
+                SELECT burger_id, SUM(added), SUM(removed), SUM(ordered), SUM(revenue)
+                FROM sales_hourly
+                WHERE hour >= ?
+                GROUP BY burger_id
+                ORDER BY SUM(ordered) DESC, SUM(added) DESC
+            ''', (since_hour,)) as cursor:
+                return orders, revenue, await cursor.fetchall()
+
+    async def get_recipients(self, after_user_id, limit):
+        # Получатели рассылки порциями по ключу: в памяти только одна порция,
+        # а читающая транзакция не держится открытой, пока идёт отправка.
+        async with self.reader() as db:
+            async with db.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                                  (after_user_id, limit)) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def create_broadcast(self, text):
+        async with self.writer() as db:
+            cursor = await db.execute('INSERT INTO broadcasts (text) VALUES (?)', (text,))
+            return cursor.lastrowid
+
+    async def get_unfinished_broadcasts(self):
+        async with self.reader() as db:
+            async with db.execute('SELECT id, text, last_user_id, sent, failed FROM broadcasts '
+                                  'WHERE finished = 0 ORDER BY id') as cursor:
+                return await cursor.fetchall()
+
+    async def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, finished=False):
+        async with self.writer() as db:
+            await db.execute('UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, finished = ? WHERE id = ?',
+                             (last_user_id, sent, failed, int(finished), broadcast_id))
+
+    async def get_user_state_record(self, user_id):
+        async with self.reader() as db:
+            async with db.execute('SELECT state, data FROM user_states WHERE user_id = ?', (user_id,)) as cursor:
+                result = await cursor.fetchone()
+                if not result:
+                    return None, {}
+                return result[0] or None, json.loads(result[1])
+
+    async def set_user_state(self, user_id, state):
+        now = int(time.time())
+        async with self.writer() as db:
+            await db.execute('''
+                INSERT INTO user_states (user_id, state, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+            ''', (user_id, state or '', now))
+            await db.execute(TOUCH_USER_SQL, (user_id, now))
+
+    async def set_user_data(self, user_id, data):
+        now = int(time.time())
+        async with self.writer() as db:
+            await db.execute('''
+                INSERT INTO user_states (user_id, state, data, updated_at) VALUES (?, '', ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+            ''', (user_id, json.dumps(data), now))
+            await db.execute(TOUCH_USER_SQL, (user_id, now))
+
+    async def save_user_state_records(self, records):
+        now = int(time.time())
+        rows = [(user_id, state or '', json.dumps(data), now) for user_id, state, data in records]
+        async with self.writer() as db:
+            await db.executemany('REPLACE INTO user_states (user_id, state, data, updated_at) VALUES (?, ?, ?, ?)',
+                                 rows)
+            await db.executemany(TOUCH_USER_SQL, [(row[0], now) for row in rows])
+
+    async def delete_stale_carts(self, before, limit, shard=(0, 1)):
+        # Корзина удаляется целиком, только если не менялась ни одна её
+        # строка: давно добавленный бургер в живой корзине остаётся.
+        # shard = (номер, всего): только корзины пользователей этого процесса
+        # (user_id % всего == номер), чьи сводки он и держит в кэше.
+        # Одна небольшая транзакция: блокировка записи держится недолго.
+        # Возвращает число удалённых корзин.
+        index, shards = shard
+        async with self.writer() as db:
+            async with db.execute('''
+                DELETE FROM cart WHERE user_id IN (
+                    SELECT user_id FROM cart WHERE user_id % ? = ?
+                    GROUP BY user_id HAVING MAX(updated_at) < ? LIMIT ?
+                )
+                RETURNING user_id
+            ''', (shards, index, before, limit)) as cursor:
+                user_ids = {row[0] for row in await cursor.fetchall()}
+        for user_id in user_ids:
+            self._invalidate_cart(user_id)
+        return len(user_ids)
+
+    async def delete_stale_user_states(self, before, limit):
+        async with self.writer() as db:
+            cursor = await db.execute('''
+                DELETE FROM user_states WHERE user_id IN (
+                    SELECT user_id FROM user_states WHERE updated_at < ? LIMIT ?
+                )
+            ''', (before, limit))
+            return cursor.rowcount
+
+    async def delete_legacy_rows(self, table, limit):
+        # user_quantities и user_remove_states больше не пишутся: количество
+        # хранится в кнопках, состояние - в user_states.
+        async with self.writer() as db:
+            cursor = await db.execute(f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} LIMIT ?)',
+                                      (limit,))
+            return cursor.rowcount
+
+    async def incremental_vacuum(self, pages):
+        # Режим INCREMENTAL включает init_db; до этого возвращать нечего.
+        async with self.writer() as db:
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                if (await cursor.fetchone())[0] != 2:
+                    return 0
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                free_pages = (await cursor.fetchone())[0]
+            # Каждый шаг запроса освобождает одну страницу, поэтому читаем до конца.
+            async with db.execute(f'PRAGMA incremental_vacuum({int(pages)})') as cursor:
+                await cursor.fetchall()
+            return min(free_pages, pages)
+
+
+class SyncRepository:
+    # Синхронная обёртка для скриптов: методы Repository выполняются в
+    # отдельном потоке со своим циклом событий, например
+    #   database.sync_repository.add_to_cart(user_id, burger_id, 2)
+    # Перед первым вызовом применяются миграции: скрипт может работать со
+    # старой базой, которую бот ещё не открывал.
+
+    def __init__(self, repository):
+        self._repository = repository
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sync-db')
+        self._loop = None
+
+    def _call(self, name, args, kwargs):
+        if self._loop is None:
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self._repository.init_db())
+            self._loop = loop
+        return self._loop.run_until_complete(getattr(self._repository, name)(*args, **kwargs))
+
+    def _run(self, name, *args, **kwargs):
+        return self._executor.submit(self._call, name, args, kwargs).result()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._repository, name)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
+        return functools.partial(self._run, name)
+
+
+repository = Repository()
+sync_repository = SyncRepository(Repository())
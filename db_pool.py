@@ -0,0 +1,69 @@
+import asyncio
+import contextlib
+import logging
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    # Несколько соединений на чтение и одно на запись: SQLite всё равно
+    # допускает только одного писателя, поэтому записи сериализуются локом.
+
+    def __init__(self, path, readers=4, pragmas=None, cached_statements=128):
+        self.path = path
+        self.readers = readers
+        self.pragmas = pragmas or {}
+        self.cached_statements = cached_statements
+        self._idle = asyncio.Queue()
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._connections = []
+
+    async def open(self):
+        self._writer = await self._connect()
+        for _ in range(self.readers):
+            self._idle.put_nowait(await self._connect())
+        logger.info('Opened SQLite pool for %s: %d readers + 1 writer', self.path, self.readers)
+
+    async def _connect(self):
+        conn = aiosqlite.connect(self.path, cached_statements=self.cached_statements)
+        # Поток соединения не должен держать процесс, если пул забыли закрыть.
+        conn.daemon = True
+        await conn
+        for name, value in self.pragmas.items():
+            await conn.execute(f'PRAGMA {name} = {value}')
+        self._connections.append(conn)
+        return conn
+
+    async def set_trace_callback(self, callback):
+        # callback вызывается из потоков aiosqlite на каждый выполненный оператор.
+        for conn in self._connections:
+            await conn.set_trace_callback(callback)
+
+    @contextlib.asynccontextmanager
+    async def reader(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def writer(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+    async def close(self):
+        async with self._write_lock:
+            for conn in self._connections:
+                await conn.close()
+            self._connections.clear()
+            self._writer = None
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+
+import config
+from keyboards import quantity_keyboard
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingEdit:
+    __slots__ = ('burger_id', 'shown', 'quantity', 'task', 'now')
+
+    def __init__(self, burger_id, shown, quantity):
+        self.burger_id = burger_id
+        self.shown = shown
+        self.quantity = quantity
+        self.task = None
+        # Установлен - правку отправить, не дожидаясь конца окна (см. flush).
+        self.now = asyncio.Event()
+
+
+class QuantityEditDebouncer:
+    # Количество живёт в данных кнопок и в отложенной правке: нажатия "+"/"-"
+    # меняют только её, а клавиатура сообщения перерисовывается один раз через
+    # delay секунд после первого нажатия - уже с итоговым количеством. Если оно совпало с тем, что на
+    # экране, запрос не отправляется вовсе (Telegram ответил бы
+    # "message is not modified").
+    # Запись о правке живёт, пока правка не отправлена; нажатия, пришедшие во
+    # время отправки, открывают следующее окно. Последнее отправленное
+    # количество запоминается (LRU): кнопки сообщения могут ещё показывать старое.
+
+    def __init__(self, bot, delay=config.QUANTITY_EDIT_DELAY, shown_cache_size=config.QUANTITY_EDIT_CACHE_SIZE):
+        self.bot = bot
+        self.delay = delay
+        self.shown_cache_size = shown_cache_size
+        self._pending = {}
+        self._shown = OrderedDict()
+        self.taps = 0
+        self.edits = 0
+        self.skipped = 0
+
+    def schedule(self, chat_id, message_id, burger_id, shown, quantity):
+        # shown - количество на клавиатуре до нажатия, quantity - после него.
+        self.taps += 1
+        key = (chat_id, message_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.burger_id = burger_id
+            pending.quantity = quantity
+            return
+        pending = self._pending[key] = _PendingEdit(burger_id, shown, quantity)
+        pending.task = asyncio.create_task(self._edit_later(key))
+
+    def current_quantity(self, chat_id, message_id):
+        # Актуальное количество: из отложенной правки, иначе из последней
+        # отправленной; None, если клавиатуру этого сообщения ещё не меняли.
+        key = (chat_id, message_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending.quantity
+        return self._shown.get(key)
+
+    async def flush(self, chat_id, message_id):
+        # Отправляет отложенную правку сразу и ждёт её, например перед
+        # добавлением в корзину: на кнопках должно остаться добавленное количество.
+        key = (chat_id, message_id)
+        while (pending := self._pending.get(key)) is not None:
+            pending.now.set()
+            await asyncio.wait({pending.task})
+            if pending.task.done() and self._pending.get(key) is pending:
+                # Правка упала, не убрав запись за собой.
+                del self._pending[key]
+
+    def _remember_shown(self, key, quantity):
+        self._shown[key] = quantity
+        self._shown.move_to_end(key)
+        if len(self._shown) > self.shown_cache_size:
+            self._shown.popitem(last=False)
+
+    async def _edit_later(self, key):
+        pending = self._pending.get(key)
+        try:
+            await asyncio.wait_for(pending.now.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+        if self._pending.get(key) is not pending:
+            return
+        quantity = pending.quantity
+        await self._edit(key, pending.burger_id, pending.shown, quantity)
+        if self._pending.get(key) is not pending:
+            return
+        if pending.quantity != quantity:
+            # Пока правка отправлялась, были новые нажатия.
+            pending.shown = quantity
+            pending.task = asyncio.create_task(self._edit_later(key))
+        else:
+            del self._pending[key]
+
+    async def _edit(self, key, burger_id, shown, quantity):
+        self._remember_shown(key, quantity)
+        if quantity == shown:
+            self.skipped += 1
+            return
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_reply_markup(
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=quantity_keyboard(burger_id, quantity)
+            )
+            self.edits += 1
+        except TelegramBadRequest as e:
+            logger.debug('Quantity keyboard in chat %s not edited: %s', chat_id, e)
+        except TelegramAPIError as e:
+            logger.warning('Failed to edit quantity keyboard in chat %s: %s', chat_id, e)
+
+    async def close(self):
+        # При остановке отправляем отложенные правки сразу, не дожидаясь таймеров.
+        pending = self._pending
+        self._pending = {}
+        for edit in pending.values():
+            edit.task.cancel()
+        await asyncio.gather(*(self._edit(key, edit.burger_id, edit.shown, edit.quantity)
+                               for key, edit in pending.items()))
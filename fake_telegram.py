@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import itertools
+import time
+
+from aiohttp import web
+
+import config
+import telegram_api
+
+# Локальная заглушка Bot API для тестов и нагрузочных прогонов. Отвечает
+# успехом на любой метод, запоминает вызовы и при превышении rate_limit
+# запросов в секунду возвращает 429 с retry_after, как настоящий Telegram.
+# Обновления, добавленные через push_update, отдаются методом getUpdates.
+#
+#   python fake_telegram.py --recipients 5000 --rate-limit 1000
+
+
+class FakeTelegram:
+    def __init__(self, rate_limit=None, retry_after=1):
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.calls = []
+        self.flood_errors = 0
+        self._message_ids = itertools.count(1)
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+
+    def push_update(self, update):
+        update = dict(update, update_id=next(self._update_ids))
+        self._updates.append(update)
+        self._new_updates.set()
+        return update['update_id']
+
+    async def _get_updates(self, payload):
+        # Как в Bot API: offset подтверждает всё, что было до него, а пустой
+        # ответ возвращается не раньше чем через timeout секунд.
+        offset = int(payload.get('offset') or 0)
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(payload.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(payload.get('limit') or 100)]
+
+    def _limited(self):
+        if self.rate_limit is None:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+        return self._window_count > self.rate_limit
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            payload = await request.json()
+        else:
+            payload = dict(await request.post())
+
+        if self._limited():
+            self.flood_errors += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            })
+
+        self.calls.append((method, payload))
+        if method.lower() in ('sendmessage', 'sendinvoice'):
+            result = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(payload.get('chat_id', 0)), 'type': 'private'},
+                'text': payload.get('text')
+            }
+        elif method.lower() == 'getupdates':
+            result = await self._get_updates(payload)
+        elif method.lower() == 'getme':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Broadcast through telegram_api.send_many to a local fake Bot API')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--recipients', type=int, default=5000)
+    parser.add_argument('--rate-limit', type=int, default=None, help='requests/sec before answering 429')
+    parser.add_argument('--concurrency', type=int, default=config.TELEGRAM_SEND_CONCURRENCY)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(rate_limit=args.rate_limit)
+    config.TELEGRAM_API_URL = await fake.start(port=args.port)
+    try:
+        started = time.perf_counter()
+        results = await telegram_api.send_many(range(args.recipients), 'Новый бургер в меню!',
+                                               concurrency=args.concurrency)
+        elapsed = time.perf_counter() - started
+    finally:
+        await telegram_api.close_session()
+        await fake.stop()
+
+    delivered = sum(1 for result in results if result.get('ok'))
+    print(f'{delivered}/{args.recipients} delivered in {elapsed:.2f}s '
+          f'({delivered / elapsed:,.0f} msg/s), 429 answered: {fake.flood_errors}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
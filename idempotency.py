@@ -0,0 +1,110 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+import config
+from callbacks import SEPARATOR, AddToCartCallback, BuyCallback, DeleteCallback, RemoveCallback
+
+logger = logging.getLogger(__name__)
+
+# Кнопки, повторное нажатие которых в течение IDEMPOTENCY_TAP_TTL считается
+# случайным двойным нажатием. "+"/"-" и листание меню сюда не входят: их
+# повторяют намеренно.
+ONCE_PREFIXES = frozenset(factory.__prefix__ for factory in
+                          (AddToCartCallback, RemoveCallback, BuyCallback, DeleteCallback))
+
+
+class ExpiringSet:
+    # Ограниченное множество ключей со сроком жизни; самые старые ключи
+    # вытесняются при переполнении.
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._expires = OrderedDict()
+
+    def add(self, key, ttl):
+        # True, если ключ уже был и не истёк; иначе запоминает его.
+        now = time.monotonic()
+        expires = self._expires.get(key)
+        if expires is not None and expires > now:
+            return True
+        self._expires[key] = now + ttl
+        self._expires.move_to_end(key)
+        while len(self._expires) > self.maxsize:
+            self._expires.popitem(last=False)
+        return False
+
+    def discard(self, key):
+        self._expires.pop(key, None)
+
+    def __len__(self):
+        return len(self._expires)
+
+
+class IdempotencyMiddleware(BaseMiddleware):
+    # Внешний middleware на Update, стоит перед FSM и очередью пользователя:
+    # повторно доставленные обновления (тот же update_id) и двойные нажатия
+    # кнопок из ONCE_PREFIXES отбрасываются до обработчиков и базы.
+    # Если обработчик упал, ключ забывается, чтобы повтор мог выполниться.
+
+    def __init__(self, maxsize=config.IDEMPOTENCY_CACHE_SIZE, update_ttl=config.IDEMPOTENCY_UPDATE_TTL,
+                 tap_ttl=config.IDEMPOTENCY_TAP_TTL):
+        self.update_ttl = update_ttl
+        self.tap_ttl = tap_ttl
+        self._keys = ExpiringSet(maxsize)
+        self.lookups = {'update': 0, 'tap': 0}
+        self.hits = {'update': 0, 'tap': 0}
+
+    def setup(self, dispatcher):
+        # Встаёт перед FSMContextMiddleware, который Dispatcher регистрирует сам
+        # и который читает состояние пользователя (из базы) на каждом
+        # обновлении: дубли отсекаются до любого обращения к хранилищу.
+        dispatcher.update.outer_middleware.unregister(dispatcher.fsm)
+        dispatcher.update.outer_middleware(self)
+        dispatcher.update.outer_middleware(dispatcher.fsm)
+        return self
+
+    @staticmethod
+    def _tap_key(event: Update):
+        query = event.callback_query
+        if query is None or not query.data or query.message is None:
+            return None
+        if query.data.split(SEPARATOR, 1)[0] not in ONCE_PREFIXES:
+            return None
+        return 'tap', query.from_user.id, query.data, query.message.message_id
+
+    def _seen(self, kind, key, ttl):
+        self.lookups[kind] += 1
+        if self._keys.add(key, ttl):
+            self.hits[kind] += 1
+            return True
+        return False
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        update_key = ('update', event.update_id)
+        if self._seen('update', update_key, self.update_ttl):
+            logger.info('Skipping redelivered update %s', event.update_id)
+            return None
+
+        tap_key = self._tap_key(event)
+        if tap_key is not None and self._seen('tap', tap_key, self.tap_ttl):
+            logger.debug('Skipping repeated tap %s', tap_key)
+            await data['bot'].answer_callback_query(event.callback_query.id)
+            return None
+
+        try:
+            return await handler(event, data)
+        except Exception:
+            self._keys.discard(update_key)
+            if tap_key is not None:
+                self._keys.discard(tap_key)
+            raise
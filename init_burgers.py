@@ -1,4 +1,4 @@
 import database
 
 
-database.add_to_cart(1940359844,13,2)
\ No newline at end of file
+database.sync_repository.add_to_cart(1940359844,13,2)
\ No newline at end of file
@@ -0,0 +1,54 @@
+from functools import lru_cache
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+from callbacks import (AddToCartCallback, BurgerCallback, DecreaseCallback, IncreaseCallback, MenuPageCallback,
+                       QuantityCallback)
+
+# Разметка клавиатур неизменяема (модели aiogram заморожены), поэтому один
+# и тот же объект можно безопасно отдавать во все обработчики.
+
+# Страницы меню по (первый id, последний id, есть ли соседние страницы);
+# сбрасываются при смене версии меню.
+_menu_cache = {}
+_menu_version = None
+
+
+def menu_keyboard(burgers, version, has_prev=False, has_next=False):
+    global _menu_version
+    if version != _menu_version:
+        _menu_cache.clear()
+        _menu_version = version
+    key = (burgers[0][0], burgers[-1][0], has_prev, has_next)
+    markup = _menu_cache.get(key)
+    if markup is None:
+        keyboard = [[InlineKeyboardButton(text=burger[1], callback_data=BurgerCallback(burger_id=burger[0]).pack())]
+                    for burger in burgers]
+        navigation = []
+        if has_prev:
+            navigation.append(InlineKeyboardButton(
+                text='« Назад', callback_data=MenuPageCallback(direction='prev', burger_id=burgers[0][0]).pack()))
+        if has_next:
+            navigation.append(InlineKeyboardButton(
+                text='Далее »', callback_data=MenuPageCallback(direction='next', burger_id=burgers[-1][0]).pack()))
+        if navigation:
+            keyboard.append(navigation)
+        markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+        _menu_cache[key] = markup
+    return markup
+
+
+@lru_cache(maxsize=config.KEYBOARD_CACHE_SIZE)
+def quantity_keyboard(burger_id, quantity):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text='-', callback_data=DecreaseCallback(burger_id=burger_id, quantity=quantity).pack()),
+            InlineKeyboardButton(text=str(quantity), callback_data=QuantityCallback(burger_id=burger_id, quantity=quantity).pack()),
+            InlineKeyboardButton(text='+', callback_data=IncreaseCallback(burger_id=burger_id, quantity=quantity).pack())
+        ],
+        [
+            InlineKeyboardButton(text='Добавить в корзину',
+                                 callback_data=AddToCartCallback(burger_id=burger_id, quantity=quantity).pack())
+        ]
+    ])
@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+import config
+
+# Нагрузочный прогон обработчиков bot.py без сети: Dispatcher из bot.py
+# получает синтетические обновления, а HTTP-сессия бота подменена заглушкой.
+# Каждый пользователь проходит сценарий
+#   /start, /burgers, бургер, "+" x N, "Добавить в корзину", /cart, удаление 1 шт.
+# и в конце печатаются перцентили времени обработки, запросы к БД на
+# обновление и пропускная способность.
+#
+#   python loadtest.py --users 2000 --taps 5
+
+# Токен должен лишь выглядеть настоящим, запросы в Telegram не уходят.
+config.TOKEN = '123456789:LOADTEST-LOADTEST-LOADTEST-LOADTEST'
+# Лимиты Telegram к заглушке не относятся, иначе очередь исходящих
+# растянула бы прогон на минуты.
+config.OUTBOX_GLOBAL_RATE = 10 ** 6
+config.OUTBOX_CHAT_RATE = 10 ** 6
+config.OUTBOX_CHAT_BURST = 10 ** 6
+
+from aiogram import methods, types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+
+from callbacks import (AddToCartCallback, BurgerCallback, DeleteCallback, IncreaseCallback,  # noqa: E402
+                       RemoveCallback)
+
+
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if isinstance(method, (methods.SendMessage, methods.SendInvoice)):
+            return types.Message(message_id=next(self._message_ids), date=datetime.datetime.now(),
+                                 chat=types.Chat(id=method.chat_id, type='private'))
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return types.User(id=user_id, is_bot=False, first_name=f'user{user_id}')
+
+    def _chat(self, user_id):
+        return types.Chat(id=user_id, type='private')
+
+    def command(self, user_id, text):
+        update_id = next(self._ids)
+        return types.Update(update_id=update_id, message=types.Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=self._chat(user_id),
+            from_user=self._user(user_id),
+            text=text,
+            entities=[types.MessageEntity(type='bot_command', offset=0, length=len(text))]
+        ))
+
+    def callback(self, user_id, data, message_id):
+        update_id = next(self._ids)
+        return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+            id=str(update_id),
+            chat_instance=str(user_id),
+            from_user=self._user(user_id),
+            data=data,
+            message=types.Message(message_id=message_id, date=datetime.datetime.now(), chat=self._chat(user_id))
+        ))
+
+
+def journey(factory, user_id, burger_ids, taps):
+    burger_id = random.choice(burger_ids)
+    message_id = user_id * 100
+    yield '/start', factory.command(user_id, '/start')
+    yield '/burgers', factory.command(user_id, '/burgers')
+    yield 'burger', factory.callback(user_id, BurgerCallback(burger_id=burger_id).pack(), message_id)
+    for quantity in range(1, taps + 1):
+        yield 'increase', factory.callback(
+            user_id, IncreaseCallback(burger_id=burger_id, quantity=quantity).pack(), message_id)
+    yield 'add_to_cart', factory.callback(
+        user_id, AddToCartCallback(burger_id=burger_id, quantity=taps + 1).pack(), message_id)
+    yield '/cart', factory.command(user_id, '/cart')
+    yield 'delete', factory.callback(user_id, DeleteCallback(burger_id=burger_id).pack(), message_id + 1)
+    yield 'remove', factory.callback(user_id, RemoveCallback(burger_id=burger_id, quantity=1).pack(), message_id + 2)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(args):
+    import bot
+    from database import repository
+
+    # aiogram пишет строку в лог на каждое обновление.
+    logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+
+    session = FakeSession()
+    bot.bot.session = session
+    await repository.init_db()
+    async with repository.writer() as db:
+        await db.executemany('INSERT INTO burgers (name, description, price) VALUES (?, ?, ?)',
+                             [(f'Бургер {i}', 'Описание', 150 + i) for i in range(args.burgers)])
+    burger_ids = [burger[0] for burger in await repository.get_burgers()]
+
+    await bot.dp.emit_startup(bot=bot.bot)
+    statements = 0
+
+    def count_statement(_):
+        nonlocal statements
+        statements += 1
+
+    pool = await repository.open()
+    await pool.set_trace_callback(count_statement)
+
+    factory = UpdateFactory()
+    latencies = defaultdict(list)
+
+    async def simulate(user_id):
+        await asyncio.sleep(random.random() * args.ramp_up)
+        for step, update in journey(factory, user_id, burger_ids, args.taps):
+            started = time.perf_counter()
+            await bot.dp.feed_update(bot.bot, update)
+            latencies[step].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+
+    outbox_stats = bot.outbox.stats()
+    await bot.dp.emit_shutdown(bot=bot.bot)
+
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    updates = len(all_latencies)
+    print(f'{args.users} users, {updates} updates in {elapsed:.2f}s -> {updates / elapsed:,.0f} updates/s')
+    print(f'DB statements per update: {statements / updates:.2f}, '
+          f'Bot API calls per update: {session.calls / updates:.2f}')
+    print(f'Outbox: {outbox_stats}')
+    print(f'{"step":<12} {"count":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for step, values in list(latencies.items()) + [('all', all_latencies)]:
+        print(f'{step:<12} {len(values):>7} '
+              f'{statistics.median(values) * 1000:>8.2f} '
+              f'{percentile(values, 0.95) * 1000:>8.2f} '
+              f'{percentile(values, 0.99) * 1000:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay synthetic Telegram updates through bot.py handlers')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--taps', type=int, default=5, help='"+" taps per user in the quantity picker')
+    parser.add_argument('--burgers', type=int, default=30)
+    parser.add_argument('--ramp-up', type=float, default=1.0, help='seconds over which users start')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DATABASE_PATH = os.path.join(tmp, 'loadtest.db')
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = defaultdict(float)
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] += amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labels, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labels, labels)} {value}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._counts = {}
+        self._sums = defaultdict(float)
+        registry.append(self)
+
+    def observe(self, *labels, value):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._sums[labels] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        names = tuple(self.labels) + ('le',)
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                yield f'{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, labels)} {self._sums[labels]}'
+            yield f'{self.name}_count{_format_labels(self.labels, labels)} {cumulative}'
+
+
+registry = []
+# Функции, обновляющие gauge-метрики прямо перед выдачей /metrics.
+collectors = []
+
+handler_seconds = Histogram('bot_handler_seconds', 'Time spent in a bot handler.', ('handler',))
+handler_errors = Counter('bot_handler_errors_total', 'Handlers that raised an exception.', ('handler',))
+db_seconds = Histogram('bot_db_seconds', 'Time spent in a repository call.', ('function',))
+db_calls = Counter('bot_db_calls_total', 'Repository calls.', ('function',))
+db_calls_per_update = Histogram('bot_db_calls_per_update', 'Repository calls made while handling one update.',
+                                buckets=(0, 1, 2, 3, 4, 5, 8, 13))
+db_seconds_per_update = Histogram('bot_db_seconds_per_update', 'Database time spent while handling one update.')
+api_seconds = Histogram('bot_api_seconds', 'Bot API request latency.', ('method',))
+outbox_depth = Gauge('bot_outbox_depth', 'Messages waiting in the outbound queue.')
+outbox_messages = Gauge('bot_outbox_messages', 'Outbound queue message counters.', ('result',))
+outbox_latency = Gauge('bot_outbox_latency_seconds', 'Time from enqueue to send.', ('stat',))
+user_queue_updates = Gauge('bot_user_queue_updates', 'Updates merged into a queued tap or dropped.', ('result',))
+user_queue_users = Gauge('bot_user_queue_users', 'Users with updates in progress or queued.')
+idempotency_lookups = Gauge('bot_idempotency_lookups', 'Updates and taps checked against the idempotency cache.',
+                            ('kind',))
+idempotency_hits = Gauge('bot_idempotency_hits', 'Duplicate updates and repeated taps that were skipped.', ('kind',))
+quantity_edits = Gauge('bot_quantity_edits', 'Quantity picker taps and the keyboard edits they produced.', ('result',))
+
+# [число вызовов БД, секунды в БД] для обновления, которое сейчас обрабатывается.
+_update_db = contextvars.ContextVar('update_db', default=None)
+
+
+def render():
+    for collector in collectors:
+        collector()
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def watch_outbox(outbox):
+    def collect():
+        stats = outbox.stats()
+        outbox_depth.set(value=stats['depth'])
+        for result in ('sent', 'delivered', 'coalesced', 'failed'):
+            outbox_messages.set(result, value=stats[result])
+        outbox_latency.set('avg', value=stats['latency_avg'])
+        outbox_latency.set('max', value=stats['latency_max'])
+    collectors.append(collect)
+
+
+def watch_user_queue(middleware):
+    def collect():
+        user_queue_updates.set('merged', value=middleware.merged)
+        user_queue_updates.set('dropped', value=middleware.dropped)
+        user_queue_users.set(value=middleware.active_users)
+    collectors.append(collect)
+
+
+def watch_quantity_edits(debouncer):
+    def collect():
+        quantity_edits.set('taps', value=debouncer.taps)
+        quantity_edits.set('edited', value=debouncer.edits)
+        quantity_edits.set('skipped', value=debouncer.skipped)
+    collectors.append(collect)
+
+
+def watch_idempotency(middleware):
+    def collect():
+        for kind, count in middleware.lookups.items():
+            idempotency_lookups.set(kind, value=count)
+        for kind, count in middleware.hits.items():
+            idempotency_hits.set(kind, value=count)
+    collectors.append(collect)
+
+
+def _instrument(name, function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_calls.inc(name)
+            db_seconds.observe(name, value=elapsed)
+            totals = _update_db.get()
+            if totals is not None:
+                totals[0] += 1
+                totals[1] += elapsed
+    return wrapper
+
+
+def instrument(repository):
+    # Подменяет публичные корутины объекта обёртками на уровне экземпляра;
+    # вызовы repository.x(...) во всех модулях начинают учитываться без
+    # изменений в них.
+    for name in dir(type(repository)):
+        method = getattr(repository, name)
+        if not name.startswith('_') and inspect.iscoroutinefunction(method):
+            setattr(repository, name, _instrument(name, method))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: вызывается только для найденного обработчика,
+    # поэтому в data['handler'] уже лежит его HandlerObject. Для кнопок
+    # настоящий обработчик выбирает CallbackRouter и кладёт его в data['route'].
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = (data.get('route') or data['handler']).callback.__name__
+        totals = [0, 0.0]
+        token = _update_db.set(totals)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(name, value=time.perf_counter() - started)
+            db_calls_per_update.observe(value=totals[0])
+            db_seconds_per_update.observe(value=totals[1])
+            _update_db.reset(token)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            api_seconds.observe(type(method).__name__, value=time.perf_counter() - started)
+
+
+async def _metrics_view(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+_runner = None
+
+
+async def start_server(host, port):
+    global _runner
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_view)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logger.info('Metrics available at http://%s:%d/metrics', host, port)
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
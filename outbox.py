@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Telegram не принимает сообщения длиннее 4096 символов.
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+@dataclass
+class _Outgoing:
+    text: str
+    reply_markup: Optional[Any] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class Outbox:
+    # Обработчики только ставят сообщения в очередь и сразу возвращаются.
+    # На каждый чат с непустой очередью работает отдельная задача, которая
+    # соблюдает лимит чата и общий лимит бота и склеивает идущие подряд
+    # текстовые сообщения в одно.
+
+    def __init__(self, bot, global_rate=config.OUTBOX_GLOBAL_RATE, chat_rate=config.OUTBOX_CHAT_RATE,
+                 chat_burst=config.OUTBOX_CHAT_BURST):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_lock = asyncio.Lock()
+        # Корзина токенов чата живёт дольше его очереди: иначе следующее
+        # сообщение получило бы полный запас и лимит чата действовал бы только
+        # внутри одной пачки. Удаляется, когда успела бы заново наполниться.
+        self._buckets = {}
+        self._buckets_swept_at = time.monotonic()
+        self._queues = {}
+        self._workers = {}
+        self.sent = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def limit_global_rate(self, rate):
+        # Когда бота обслуживают несколько процессов, общий лимит делится между ними.
+        self._global = TokenBucket(rate, rate)
+
+    @property
+    def global_rate(self):
+        return self._global.rate
+
+    async def acquire(self):
+        # Токен общего лимита бота. Им же пользуются отправки мимо очереди
+        # (рассылки), чтобы вместе с ответами не превышать лимит Telegram.
+        async with self._global_lock:
+            await self._global.acquire()
+
+    @property
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'latency_avg': self.latency_total / self.delivered if self.delivered else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    def send(self, chat_id, text, reply_markup=None):
+        self._queues.setdefault(chat_id, deque()).append(_Outgoing(text, reply_markup))
+        if chat_id not in self._workers:
+            self._sweep_buckets()
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    def _sweep_buckets(self):
+        now = time.monotonic()
+        refill_time = self.chat_burst / self.chat_rate
+        if now - self._buckets_swept_at < refill_time:
+            return
+        self._buckets_swept_at = now
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._workers and now - bucket.updated >= refill_time]:
+            del self._buckets[chat_id]
+
+    def _next_batch(self, queue):
+        # Склеиваем только сообщения без клавиатуры; клавиатура допустима у
+        # последнего из склеенных, иначе кнопки окажутся не под тем текстом.
+        batch = [queue.popleft()]
+        length = len(batch[0].text)
+        while batch[-1].reply_markup is None and queue:
+            following = queue[0]
+            length += len(following.text) + 2
+            if length > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(queue.popleft())
+        return batch
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        try:
+            while queue:
+                await bucket.acquire()
+                await self.acquire()
+                batch = self._next_batch(queue)
+                text = '\n\n'.join(message.text for message in batch)
+                try:
+                    await self.bot.send_message(chat_id, text, reply_markup=batch[-1].reply_markup)
+                except TelegramRetryAfter as e:
+                    logger.warning('Flood limit for chat %s, retrying in %s s', chat_id, e.retry_after)
+                    queue.extendleft(reversed(batch))
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except TelegramAPIError as e:
+                    logger.warning('Failed to send message to chat %s: %s', chat_id, e)
+                    self.failed += len(batch)
+                    continue
+
+                now = time.monotonic()
+                self.sent += 1
+                self.delivered += len(batch)
+                self.coalesced += len(batch) - 1
+                for message in batch:
+                    latency = now - message.enqueued_at
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+        finally:
+            del self._workers[chat_id]
+            if queue:
+                # Сюда попадаем только при отмене задачи; недоставленное теряется.
+                logger.warning('Dropped %d queued messages for chat %s', len(queue), chat_id)
+            del self._queues[chat_id]
+
+    async def close(self, timeout=config.OUTBOX_DRAIN_TIMEOUT):
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.info('Outbox closed: %s', self.stats())
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import config
+from database import repository
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Record:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+
+
+class WriteBehindStorage(BaseStorage):
+    # Состояние пользователей живёт в памяти, а в таблицу user_states
+    # попадает пачками раз в FSM_FLUSH_INTERVAL секунд и при остановке бота.
+    # Несколько изменений одного пользователя между сбросами дают одну запись.
+    # В памяти держится не больше max_records пользователей (LRU): после
+    # сброса давно не обращавшиеся записи, уже сохранённые в базе, забываются
+    # и при следующем обращении читаются из неё заново.
+
+    def __init__(self, flush_interval=config.FSM_FLUSH_INTERVAL, batch_size=config.FSM_FLUSH_BATCH,
+                 max_records=config.FSM_CACHE_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_records = max_records
+        self._records = OrderedDict()
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush user states')
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._dirty:
+                batch = [self._dirty.pop() for _ in range(min(self.batch_size, len(self._dirty)))]
+                rows = [(user_id, self._records[user_id].state, self._records[user_id].data) for user_id in batch]
+                try:
+                    await repository.save_user_state_records(rows)
+                except BaseException:
+                    self._dirty.update(batch)
+                    raise
+            self._evict()
+
+    def _evict(self):
+        # Несохранённые записи не вытесняются, даже если их больше max_records.
+        excess = len(self._records) - self.max_records
+        if excess <= 0:
+            return
+        clean = []
+        for user_id in self._records:
+            if user_id not in self._dirty:
+                clean.append(user_id)
+                if len(clean) == excess:
+                    break
+        for user_id in clean:
+            del self._records[user_id]
+
+    async def _record(self, key: StorageKey):
+        record = self._records.get(key.user_id)
+        if record is None:
+            state, data = await repository.get_user_state_record(key.user_id)
+            record = self._records.setdefault(key.user_id, _Record(state, data))
+        self._records.move_to_end(key.user_id)
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._dirty.add(key.user_id)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        record.data = data.copy()
+        self._dirty.add(key.user_id)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+class SQLiteStorage(BaseStorage):
+    # Без кэша в памяти: каждое чтение и запись идут в user_states. Подходит,
+    # когда обновления одного пользователя обрабатывают разные процессы,
+    # работающие с общим файлом базы в режиме WAL.
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await repository.set_user_state(key.user_id, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await repository.get_user_state_record(key.user_id))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await repository.set_user_data(key.user_id, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await repository.get_user_state_record(key.user_id))[1]
+
+    async def close(self) -> None:
+        pass
+
+
+def make_storage(backend=None):
+    backend = backend or config.STATE_BACKEND
+    if backend == 'memory':
+        return WriteBehindStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'redis':
+        # Пакет redis нужен только для этого варианта.
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(config.REDIS_URL)
+    raise ValueError(f'Unknown STATE_BACKEND: {backend!r}')
@@ -1,12 +1,76 @@
+import asyncio
+import logging
+import time
+
 import aiohttp
+
+import config
 from config import TOKEN
 
-async def send_message(chat_id, text, TOKEN):
-    url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
+logger = logging.getLogger(__name__)
+
+# Одна сессия на процесс: соединения с api.telegram.org держатся открытыми
+# (keep-alive), так что TLS и DNS не повторяются на каждое сообщение.
+_session = None
+# До какого момента (time.monotonic) Telegram просил не слать запросы после 429.
+_flood_until = 0.0
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=config.TELEGRAM_HTTP_POOL_SIZE, ttl_dns_cache=300,
+                                         keepalive_timeout=60)
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _wait_flood():
+    delay = _flood_until - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def send_message(chat_id, text, TOKEN=TOKEN):
+    global _flood_until
+    url = f"{config.TELEGRAM_API_URL}/bot{TOKEN}/sendMessage"
     payload = {
         'chat_id': chat_id,
         'text': text
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            return await response.json()
\ No newline at end of file
+    for attempt in range(config.TELEGRAM_MAX_RETRIES + 1):
+        await _wait_flood()
+        async with get_session().post(url, json=payload) as response:
+            result = await response.json()
+        if result.get('error_code') != 429 or attempt == config.TELEGRAM_MAX_RETRIES:
+            return result
+        retry_after = result.get('parameters', {}).get('retry_after', 1)
+        logger.warning('Flood limit hit, retrying in %s s', retry_after)
+        _flood_until = max(_flood_until, time.monotonic() + retry_after)
+    return result
+
+
+async def send_many(chat_ids, text, TOKEN=TOKEN, concurrency=config.TELEGRAM_SEND_CONCURRENCY, limiter=None):
+    # limiter - корутина, которую ждут перед каждой отправкой (ограничение скорости).
+    chat_ids = list(chat_ids)
+    results = [None] * len(chat_ids)
+    positions = iter(range(len(chat_ids)))
+
+    async def worker():
+        for position in positions:
+            try:
+                if limiter is not None:
+                    await limiter()
+                results[position] = await send_message(chat_ids[position], text, TOKEN)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                results[position] = {'ok': False, 'description': str(e)}
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(chat_ids)))))
+    return results
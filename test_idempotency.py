@@ -0,0 +1,62 @@
+import asyncio
+import contextlib
+import datetime
+import shutil
+
+from aiogram import Bot, Dispatcher, types
+
+import config
+from database import repository
+from idempotency import IdempotencyMiddleware
+from storage import SQLiteStorage
+
+
+def make_update(update_id):
+    return types.Update(update_id=update_id, message=types.Message(
+        message_id=update_id, date=datetime.datetime.now(), chat=types.Chat(id=7, type='private'),
+        from_user=types.User(id=7, is_bot=False, first_name='u'), text='hello'))
+
+
+def count_database_access(monkeypatch, counter):
+    # Любой запрос к базе идёт через reader() или writer() репозитория.
+    def wrap(open_connection):
+        @contextlib.asynccontextmanager
+        async def counted():
+            counter.append(open_connection.__name__)
+            async with open_connection() as db:
+                yield db
+        return counted
+    monkeypatch.setattr(repository, 'reader', wrap(repository.reader))
+    monkeypatch.setattr(repository, 'writer', wrap(repository.writer))
+
+
+def test_duplicate_update_skips_fsm_storage(tmp_path, monkeypatch):
+    path = tmp_path / 'burgers.db'
+    shutil.copy(config.DATABASE_PATH, path)
+    monkeypatch.setattr(config, 'DATABASE_PATH', str(path))
+
+    dp = Dispatcher(storage=SQLiteStorage())
+    IdempotencyMiddleware().setup(dp)
+    handled = []
+
+    @dp.message()
+    async def handler(message: types.Message):
+        handled.append(message.message_id)
+
+    async def run():
+        await repository.init_db()
+        bot = Bot('123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+        accesses = []
+        count_database_access(monkeypatch, accesses)
+        try:
+            await dp.feed_update(bot, make_update(1))
+            assert accesses
+            accesses.clear()
+            await dp.feed_update(bot, make_update(1))
+            assert accesses == []
+        finally:
+            await repository.close()
+            await bot.session.close()
+
+    asyncio.run(run())
+    assert handled == [1]
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+import config
+from callbacks import SEPARATOR, DecreaseCallback, IncreaseCallback
+
+logger = logging.getLogger(__name__)
+
+# Нажатия, которые можно склеить: несколько одинаковых "+" подряд по одному
+# сообщению обрабатываются как одно обновление с repeat=N.
+MERGEABLE_PREFIXES = tuple(factory.__prefix__ + SEPARATOR for factory in (IncreaseCallback, DecreaseCallback))
+
+# Не ждут в очереди пользователя: ничего не меняют в его состоянии, а на
+# shipping_query и pre_checkout_query Telegram ждёт ответа не дольше 10 секунд.
+UNORDERED_UPDATES = ('inline_query', 'shipping_query', 'pre_checkout_query')
+
+
+class _Pending:
+    __slots__ = ('merge_key', 'data', 'ready')
+
+    def __init__(self, merge_key, data):
+        self.merge_key = merge_key
+        self.data = data
+        self.ready = None
+
+
+class UserSerialMiddleware(BaseMiddleware):
+    # Внешний middleware на Update: обновления одного пользователя выполняются
+    # строго по очереди, разные пользователи обрабатываются параллельно.
+    # Первый элемент очереди пользователя - выполняющееся обновление.
+
+    def __init__(self, max_pending=config.USER_QUEUE_SIZE):
+        self.max_pending = max_pending
+        self._queues = {}
+        self.merged = 0
+        self.dropped = 0
+
+    @property
+    def active_users(self):
+        return len(self._queues)
+
+    @staticmethod
+    def _merge_key(event: Update):
+        query = event.callback_query
+        if query is None or not query.data or query.message is None:
+            return None
+        if query.data.startswith(MERGEABLE_PREFIXES):
+            return query.data, query.message.message_id
+        return None
+
+    @staticmethod
+    async def _answer(event: Update, data: Dict[str, Any]):
+        # Для пропущенных нажатий всё равно гасим "часики" на кнопке.
+        if event.callback_query is not None:
+            await data['bot'].answer_callback_query(event.callback_query.id)
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None or event.event_type in UNORDERED_UPDATES:
+            return await handler(event, data)
+
+        queue = self._queues.get(user.id)
+        if queue is None:
+            queue = self._queues[user.id] = deque()
+
+        merge_key = self._merge_key(event)
+        if merge_key is not None and len(queue) > 1 and queue[-1].merge_key == merge_key:
+            waiting = queue[-1].data
+            waiting['repeat'] = waiting.get('repeat', 1) + 1
+            self.merged += 1
+            await self._answer(event, data)
+            return None
+
+        if len(queue) > self.max_pending:
+            self.dropped += 1
+            logger.warning('Dropping update %s: %d updates already queued for user %s',
+                           event.update_id, len(queue), user.id)
+            await self._answer(event, data)
+            return None
+
+        entry = _Pending(merge_key, data)
+        queue.append(entry)
+        try:
+            if len(queue) > 1:
+                entry.ready = asyncio.get_running_loop().create_future()
+                await entry.ready
+            return await handler(event, data)
+        finally:
+            was_running = queue[0] is entry
+            queue.remove(entry)
+            if not queue:
+                del self._queues[user.id]
+            elif was_running and not queue[0].ready.done():
+                queue[0].ready.set_result(None)